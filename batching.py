@@ -0,0 +1,55 @@
+"""Batching of static content writes, for the batched() decorator.
+
+This module imports no other module of the app at import time, unlike
+static, which models and generators import in a cycle. That lets them
+decorate their methods with batched() while the cycle is being imported.
+"""
+
+import threading
+
+# Holds the static.Batch that set() and remove() add to, if any.
+_local = threading.local()
+
+
+def current():
+  """Returns the Batch being collected in this thread, or None."""
+  return getattr(_local, 'batch', None)
+
+
+def batched(func):
+  """Decorator that commits the static content written by func in one batch.
+
+  Calls to static.set() and static.remove() made while func runs are
+  queued, and stored together once func returns. If func raises, nothing
+  is stored.
+  """
+  def wrapper(*args, **kwargs):
+    if current() is not None:
+      return func(*args, **kwargs)
+    import static
+    _local.batch = batch = static.Batch()
+    try:
+      result = func(*args, **kwargs)
+    finally:
+      _local.batch = None
+    batch.commit()
+    return result
+  wrapper.__name__ = func.__name__
+  wrapper.__doc__ = func.__doc__
+  return wrapper
+
+
+def collect(func, *args, **kwargs):
+  """Runs func, and returns the Batch of what it set and removed, uncommitted.
+
+  This lets content be rendered in one thread or process and stored from
+  another, by calling commit() on the batch.
+  """
+  import static
+  previous = current()
+  _local.batch = batch = static.Batch()
+  try:
+    func(*args, **kwargs)
+  finally:
+    _local.batch = previous
+  return batch
@@ -38,6 +38,67 @@ posts_per_page = 10
 tag_cloud_max_size = 100
 tag_cloud_min_fontsize = 0.75 # Min font size in tag clouds (em)
 tag_cloud_max_fontsize = 2.0 # Max font size in tag clouds (em)
+# Maximum number of authors in the author cloud
+author_cloud_max_size = 20
+# Number of shards for each tag's count. More shards allow more concurrent
+# edits, but make building the tag cloud slower.
+tag_counter_shards = 10
+
+# Bytes of static content each instance keeps decoded in memory, and how
+# often (in seconds) it checks whether another instance changed the store.
+static_cache_size = 8 * 1024 * 1024
+static_cache_check_interval = 1
+
+# Seconds to remember that a path has no static content, so repeated requests
+# for missing pages don't each cost a datastore read.
+static_negative_cache_ttl = 60
+
+# Seconds static content stays in memcache before it is reloaded. Hot paths
+# are reloaded a little early by a single request, scaled by
+# static_refresh_beta; other requests wait up to static_lease_time seconds
+# for that reload rather than all reading the datastore at once.
+static_memcache_ttl = 60 * 60
+static_refresh_beta = 1.0
+static_lease_time = 2
+
+# Most URLs listed in one sitemap shard, up to 50,000. A shard that outgrows
+# this is split in two when it's next regenerated; shards are only merged
+# when the sitemap is sharded afresh, by post_deploy.SitemapRegenerator.
+sitemap_shard_size = 1000
+
+# Number of user identities (name and author page) each instance caches, and
+# for how many seconds, before checking memcache for changes.
+identity_cache_size = 1000
+identity_cache_ttl = 10
+
+# If a caching proxy that supports surrogate keys sits in front of the app,
+# set this to the URL that purges keys from it. Keys are sent, space
+# separated, in a POST's Surrogate-Key header, along with any headers below
+# (e.g. {'Fastly-Key': '...'}).
+surrogate_purge_url = None
+surrogate_purge_headers = {}
+
+# Where static content is kept: 'datastore' on App Engine, or 'sqlite' to keep
+# it in local files (static_sqlite_path, plus the same name with '.data' for
+# the bodies), e.g. when self-hosting the read path or for benchmarks.
+static_backend = 'datastore'
+static_sqlite_path = 'static.db'
+
+# How rebuilds run generate_resource jobs: 'taskqueue' on App Engine, or
+# 'threads' or 'processes' to run generator_workers at once locally, as
+# rebuild_site.py does.
+generator_executor = 'taskqueue'
+generator_workers = 4
+# Seconds without any job finishing before a process pool gives up the rest.
+generator_job_timeout = 300
+
+# Number of listing pages to render in a single task; longer listings are
+# continued in further tasks.
+listing_pages_per_task = 20
+
+# Seconds to wait before regenerating listings, tag pages and feeds after a
+# post changes, so that a burst of edits regenerates each of them once.
+regenerate_delay = 10
 
 # The mime type to serve HTML files as.
 html_mime_type = "text/html; charset=utf-8"
@@ -0,0 +1,294 @@
+"""Executors, which run the generate_resource jobs of ContentGenerators.
+
+A job is a (generator_class, args) pair, run as
+generator_class.generate_resource(*args). TaskQueueExecutor, used on App
+Engine, runs each job in its own task. The local executors are for
+rebuilding a whole site outside App Engine, as rebuild_site.py does: they
+render jobs in parallel, on a pool of threads or processes, and store what
+the jobs render from the thread that calls join(), one job's content at a
+time.
+"""
+
+import logging
+import pickle
+import Queue
+import threading
+import time
+from google.appengine.ext import deferred
+
+import config
+import generators
+import utils
+
+
+class TaskQueueExecutor(object):
+    """Runs each job in a task."""
+
+    def submit(self, generator_class, *args):
+        generators.defer_generate(generator_class, *args)
+
+    def mark_dirty(self, generator_class, resource):
+        generators.mark_dirty(generator_class, resource)
+
+    def defer(self, func, *args):
+        """Calls func(*args) in a task, to continue work in batches."""
+        deferred.defer(func, *args)
+
+    def map(self, func, items):
+        """Returns [func(x) for x in items]."""
+        return [func(x) for x in items]
+
+    def join(self):
+        pass
+
+
+def _run(work):
+    """Runs a (func, args) work item, and returns (work, func(*args)), or
+    (work, None) if it raises.
+
+    A job is run as the work item (generators.run_job, job), which returns
+    (batch, jobs).
+    """
+    func, args = work
+    try:
+        return work, func(*args)
+    except Exception:
+        logging.exception('Running %r failed', args)
+        return work, None
+
+
+class LocalExecutor(object):
+    """Base class for executors that run jobs on pools in this process.
+
+    Jobs are held until join() is called, so that they all see whatever was
+    stored before then. Subclasses implement _open(), which starts the pool,
+    _start(work), which runs _run(work) on it, _next_result(), which
+    returns what the next work item to finish returned, and close().
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.results = Queue.Queue()
+        self.running = False
+        self.waiting = []
+        self.pending = 0
+        self.seen = {}
+        self.failed = []
+
+    def submit(self, generator_class, *args):
+        key = (generator_class.name(), repr(args))
+        if key in self.seen:
+            return
+        self.seen[key] = True
+        self.pending += 1
+        if self.running:
+            self._start((generators.run_job, (generator_class, args)))
+        else:
+            self.waiting.append((generator_class, args))
+
+    def mark_dirty(self, generator_class, resource):
+        self.submit(generator_class, None, resource)
+
+    def defer(self, func, *args):
+        """Calls func(*args) now; there's no request deadline to split at."""
+        func(*args)
+
+    def map(self, func, items):
+        """Returns [func(x) for x in items], computed in parallel, with None
+        for any that raise.
+
+        This runs on a pool of its own, so jobs submitted so far still wait
+        for join(), and see whatever is stored in the meantime.
+        """
+        works = [(func, (x,)) for x in items]
+        if not works:
+            return []
+        results = {}
+        self._open()
+        try:
+            for work in works:
+                self._start(work)
+            for work in works:
+                done, result = self._next_result()
+                results[id(done)] = result
+        finally:
+            self.close()
+        return [results.get(id(x)) for x in works]
+
+    def join(self):
+        """Runs the jobs, storing the content of each as it finishes.
+
+        Returns:
+          A list of the jobs that failed.
+        """
+        self._open()
+        self.running = True
+        for job in self.waiting:
+            self._start((generators.run_job, job))
+        self.waiting = []
+        try:
+            while self.pending:
+                work, result = self._next_result()
+                job = work[1]
+                self.pending -= 1
+                if result is None:
+                    self.failed.append(job)
+                    continue
+                batch, jobs = result
+                batch.commit()
+                for generator_class, args in jobs:
+                    self.submit(generator_class, *args)
+        finally:
+            self.running = False
+            self.close()
+        return self.failed
+
+
+class ThreadPoolExecutor(LocalExecutor):
+    """Runs jobs on a pool of threads.
+
+    Templates and markup are rendered with the GIL held, so this mostly
+    overlaps API calls; ProcessPoolExecutor scales rendering with cores.
+    """
+
+    def _open(self):
+        # render_template points Django's global settings at the templates,
+        # and back, around each render; a thread putting them back while
+        # another is rendering would break its includes. So they are
+        # pointed at the templates once, for as long as the pool runs.
+        self.old_settings = utils._swap_settings(
+            {'TEMPLATE_DIRS': utils.TEMPLATE_DIRS})
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _start(self, work):
+        self.jobs.put(work)
+
+    def _next_result(self):
+        return self.results.get()
+
+    def _work(self):
+        while True:
+            work = self.jobs.get()
+            if work is None:
+                return
+            self.results.put(_run(work))
+
+    def close(self):
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        utils._swap_settings(self.old_settings)
+
+
+def _init_process():
+    """Opens the static backend afresh in each worker process, rather than
+    sharing the connections and maps it had in the parent."""
+    import static
+    static.reset_backend()
+
+
+def _work_process(jobs, results):
+    """Runs work items from the jobs queue in a worker process until it's
+    sent None.
+
+    Results are pickled here, so that one that can't be pickled fails its
+    job, rather than being dropped by the queue.
+    """
+    _init_process()
+    while True:
+        item = jobs.get()
+        if item is None:
+            return
+        number, work = item
+        work, result = _run(work)
+        try:
+            results.put(pickle.dumps((number, result), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            logging.exception('Returning from %r failed', work[1])
+            results.put(pickle.dumps((number, None), pickle.HIGHEST_PROTOCOL))
+
+
+class ProcessPoolExecutor(LocalExecutor):
+    """Runs jobs on a pool of forked processes.
+
+    Each process works from the API stubs as they were when join() was
+    called, but opens its own static backend. A worker that dies loses its
+    job; once no job has finished for config.generator_job_timeout seconds,
+    or every worker has died, the jobs still outstanding are given up as
+    failed. Needs the multiprocessing module, from Python 2.6.
+    """
+
+    def _open(self):
+        import multiprocessing
+        self.jobs = multiprocessing.Queue()
+        self.process_results = multiprocessing.Queue()
+        self.processes = []
+        for i in range(self.workers):
+            process = multiprocessing.Process(
+                target=_work_process, args=(self.jobs, self.process_results))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.outstanding = {}
+        self.numbered = 0
+        self.last_progress = time.time()
+
+    def _start(self, work):
+        self.numbered += 1
+        self.outstanding[self.numbered] = work
+        self.jobs.put((self.numbered, work))
+
+    def _next_result(self):
+        while True:
+            try:
+                number, result = pickle.loads(
+                    self.process_results.get(timeout=1))
+            except Queue.Empty:
+                alive = [p for p in self.processes if p.is_alive()]
+                waited = time.time() - self.last_progress
+                if alive and waited < config.generator_job_timeout:
+                    continue
+                number = min(self.outstanding)
+                logging.error('Gave up waiting for %r',
+                              self.outstanding[number][1])
+                result = None
+            self.last_progress = time.time()
+            return self.outstanding.pop(number), result
+
+    def close(self):
+        if self.outstanding:
+            # Jobs left in the queue needn't be flushed to dead workers.
+            self.jobs.cancel_join_thread()
+        for process in self.processes:
+            if self.outstanding:
+                process.terminate()
+            else:
+                self.jobs.put(None)
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+
+def get_executor(name=None, workers=None):
+    """Returns the executor called name, by default config.generator_executor.
+
+    Args:
+      name: 'taskqueue', 'threads' or 'processes'.
+      workers: The size of the pool, by default config.generator_workers.
+    """
+    name = name or config.generator_executor
+    workers = workers or config.generator_workers
+    if name == 'threads':
+        return ThreadPoolExecutor(workers)
+    if name == 'processes':
+        return ProcessPoolExecutor(workers)
+    return TaskQueueExecutor()
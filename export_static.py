@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Mirrors the static content store to a directory tree.
+
+Each page is written as an anonymous visitor would see it, along with a
+gzipped sibling where one is stored, so that a plain web server or CDN can
+serve the site. A manifest in the output directory records the ETag of every
+exported path, and later runs only write the paths whose ETag changed and
+delete the files of paths that were removed.
+
+Content is read from a local datastore file, as written by dev_appserver.py
+--datastore_path, or from a deployed app through /remote_api.
+
+Usage:
+  export_static.py --datastore_path=FILE OUTPUT_DIR
+  export_static.py --host=HOST OUTPUT_DIR
+"""
+
+import datetime
+import getpass
+import hashlib
+import optparse
+import os
+import sys
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+import fix_path
+import config
+
+MANIFEST_NAME = '.manifest.json'
+MANIFEST_DATE_FMT = '%Y-%m-%d %H:%M:%S'
+
+# Static content fetched at once.
+BATCH_SIZE = 20
+
+
+def setup_stubs(app_id, datastore_path=None, host=None):
+    """Sets up the App Engine APIs that reading and writing static content need.
+
+    Tasks are queued in a local stub, which never runs them; there is no
+    urlfetch stub, so nothing run here should contact other services.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    from google.appengine.api.taskqueue import taskqueue_stub
+
+    os.environ['APPLICATION_ID'] = app_id
+    os.environ.setdefault('SERVER_SOFTWARE', 'Export/1.0')
+    os.environ.setdefault('SERVER_NAME', config.host)
+    os.environ.setdefault('SERVER_PORT', '80')
+    os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+    os.environ.setdefault('USER_EMAIL', '')
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'memcache', memcache_stub.MemcacheServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'user', user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'taskqueue', taskqueue_stub.TaskQueueServiceStub(
+            root_path=os.path.dirname(os.path.abspath(__file__))))
+    if host:
+        from google.appengine.ext.remote_api import remote_api_stub
+        def auth_func():
+            return raw_input('Email: '), getpass.getpass('Password: ')
+        remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api',
+                                                 auth_func, host)
+    else:
+        from google.appengine.api import datastore_file_stub
+        apiproxy_stub_map.apiproxy.RegisterStub(
+            'datastore_v3',
+            datastore_file_stub.DatastoreFileStub(app_id, datastore_path, None))
+
+
+def file_name(path):
+    """Returns the file, relative to the output directory, for a path."""
+    import static
+    if path == static.NOT_FOUND_PATH:
+        return '404.html'
+    name = path.lstrip('/')
+    if not name or name.endswith('/'):
+        return name + 'index.html'
+    if '.' not in name.rsplit('/', 1)[-1]:
+        # Pages like /2010/05/slug can have pages below them, so they are
+        # written as directory indexes.
+        return name + '/index.html'
+    return name
+
+
+def write_file(output_dir, name, pieces):
+    """Writes the strings in pieces to a file, replacing it atomically."""
+    filename = os.path.join(output_dir, *name.split('/'))
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    temp = filename + '.tmp'
+    f = open(temp, 'wb')
+    try:
+        for piece in pieces:
+            f.write(piece)
+    finally:
+        f.close()
+    if os.path.exists(filename):
+        os.remove(filename) # os.rename won't replace files on Windows.
+    os.rename(temp, filename)
+
+
+def remove_file(output_dir, name):
+    filename = os.path.join(output_dir, *name.split('/'))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def anonymous_fills():
+    """Returns the slot fills and their version for an anonymous visitor."""
+    from google.appengine.api import users
+    import static
+    home = 'http://%s%s/' % (config.host, config.url_prefix)
+    return static.get_slot_fills({
+        'loginout_url': users.create_login_url(home),
+        'user_name': 'Anonymous',
+        'url_linktext': 'Login',
+        'is_admin': False,
+        'logged_in': False,
+    })
+
+
+def export(output_dir, full=False):
+    """Brings the mirror in output_dir up to date with the static store.
+
+    Args:
+      output_dir: The directory to write to.
+      full: True to check every path, rather than only those modified since
+        the last export.
+    Returns:
+      A (written, removed) tuple with the number of paths of each.
+    """
+    import static
+
+    manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        manifest = json.load(open(manifest_file))
+    else:
+        manifest = {}
+    exported = manifest.setdefault('paths', {})
+
+    fills, version = anonymous_fills()
+    if version != manifest.get('fills'):
+        # The sidebar or header changed, so every page in base.html did.
+        full = True
+    since = manifest.get('since')
+    if since:
+        since = datetime.datetime.strptime(since, MANIFEST_DATE_FMT)
+
+    store = static.backend()
+    paths = store.modified_paths()
+    if full or not since:
+        candidates = paths
+    else:
+        # last_modified is only stored to the minute, so this includes
+        # anything written during the last export's final minute.
+        candidates = store.modified_paths(since)
+    candidates = [x for x in candidates
+                  if x.startswith('/') or x == static.NOT_FOUND_PATH]
+
+    written = 0
+    latest = since
+    for i in range(0, len(candidates), BATCH_SIZE):
+        batch = candidates[i:i + BATCH_SIZE]
+        for path, content in zip(batch, store.get_multi(batch)):
+            if not content:
+                continue
+            if not latest or content.last_modified > latest:
+                latest = content.last_modified
+            if content.status != 200 and path != static.NOT_FOUND_PATH:
+                continue # Redirects and errors need a real server.
+            content_fills = None
+            etag = content.etag
+            if static.uses_base_template(path) or content.slots:
+                content_fills = fills
+                etag = hashlib.sha1('%s:%s' % (content.etag, version)).hexdigest()
+            if exported.get(path, {}).get('etag') == etag:
+                continue
+            name = file_name(path)
+            write_file(output_dir, name,
+                       static.get_pieces(content, content_fills, False))
+            if content.has_gzip:
+                write_file(output_dir, name + '.gz',
+                           static.get_pieces(content, content_fills, True))
+            elif path in exported:
+                remove_file(output_dir, name + '.gz')
+            exported[path] = {
+                'etag': etag,
+                'file': name,
+                'content_type': content.content_type,
+            }
+            written += 1
+
+    removed = 0
+    current = dict((x, True) for x in paths)
+    for path in exported.keys():
+        if path not in current:
+            remove_file(output_dir, exported[path]['file'])
+            remove_file(output_dir, exported[path]['file'] + '.gz')
+            del exported[path]
+            removed += 1
+
+    manifest['fills'] = version
+    if latest:
+        manifest['since'] = latest.strftime(MANIFEST_DATE_FMT)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    temp = manifest_file + '.tmp'
+    f = open(temp, 'w')
+    try:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    os.rename(temp, manifest_file)
+    return written, removed
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] OUTPUT_DIR',
+        description='Mirrors the static content store to OUTPUT_DIR.')
+    parser.add_option('--app_id', default='jugglethis-wikiblog',
+                      help='The application id, as in app.yaml.')
+    parser.add_option('--datastore_path',
+                      help='Read from this dev_appserver datastore file.')
+    parser.add_option('--host',
+                      help='Read from the app at this host, via /remote_api.')
+    parser.add_option('--full', action='store_true', default=False,
+                      help='Check every path, not just recently modified ones.')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1 or bool(options.datastore_path) == bool(options.host):
+        parser.error('Give an OUTPUT_DIR and one of --datastore_path or --host.')
+
+    fix_path.fix_sys_path()
+    setup_stubs(options.app_id, options.datastore_path, options.host)
+    written, removed = export(args[0], options.full)
+    print 'Wrote %d paths, removed %d.' % (written, removed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
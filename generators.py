@@ -1,12 +1,18 @@
 import datetime
-import itertools
+import hashlib
+import heapq
 import os
+import threading
+import time
 import urllib
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
 import fix_path
+import batching
 import config
 import markup
 import static
@@ -15,6 +21,77 @@ import utils
 
 generator_list = []
 
+# FragmentContentGenerators, which render the fragments of the sidebar.
+fragment_list = []
+
+
+# Jobs asked for in this thread, while collect_jobs is collecting them.
+_local = threading.local()
+
+
+def defer_generate(generator_class, *args):
+    """Calls generator_class.generate_resource(*args) later.
+
+    That's in a task, unless this is running a job for an executor, in which
+    case it's another job for the same executor.
+    """
+    jobs = getattr(_local, 'jobs', None)
+    if jobs is not None:
+        jobs.append((generator_class, args))
+    else:
+        deferred.defer(generator_class.generate_resource, *args)
+
+
+def mark_dirty(generator_class, resource):
+    """Schedules a resource to be regenerated at the end of the current window.
+
+    Regeneration is debounced: every mark for the same resource within one
+    window of config.regenerate_delay seconds shares a single named task, so
+    a burst of edits regenerates each resource once.
+    """
+    if getattr(_local, 'jobs', None) is not None:
+        defer_generate(generator_class, None, resource)
+        return
+    window = config.regenerate_delay
+    now = time.time()
+    slot = int(now // window) + 1
+    resource_hash = hashlib.sha1(
+        '%s:%r' % (generator_class.name(), resource)).hexdigest()
+    try:
+        deferred.defer(generator_class.generate_resource, None, resource,
+                       _name='regen-%s-%d' % (resource_hash, slot),
+                       _countdown=slot * window - now)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass # Already due to be regenerated at the end of this window.
+
+
+def collect_jobs(func, *args):
+    """Calls func(*args), and returns the jobs it asked for.
+
+    Jobs are (generator_class, args) pairs, for anything func would have
+    passed to defer_generate or mark_dirty, which run nothing themselves.
+    """
+    previous = getattr(_local, 'jobs', None)
+    _local.jobs = jobs = []
+    try:
+        func(*args)
+    finally:
+        _local.jobs = previous
+    return jobs
+
+
+def run_job(generator_class, args):
+    """Runs generator_class.generate_resource(*args) without storing anything.
+
+    Returns:
+      A (batch, jobs) tuple: the uncommitted static.Batch of what it wrote,
+      and the further jobs it asked for, as for collect_jobs.
+    """
+    batches = []
+    jobs = collect_jobs(lambda: batches.append(
+        batching.collect(generator_class.generate_resource, *args)))
+    return batches[0], jobs
+
 
 class ContentGenerator(object):
     """A class that generates content and dependency lists for blog posts."""
@@ -22,6 +99,11 @@ class ContentGenerator(object):
     can_defer = True
     """If True, this ContentGenerator's resources can be generated later."""
 
+    updates_post = False
+    """If True, generate_resource records what it did on the post it is given,
+    so it's always run with the post, which the caller then saves. Its
+    generate_resource takes action='delete' when the post is removed."""
+
     @classmethod
     def name(cls):
         """ returns a unique name for the ContentGenerator.
@@ -59,6 +141,19 @@ class ContentGenerator(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def get_surrogate_keys(cls, *args):
+        """Returns the surrogate keys to tag this generator's content with.
+
+        The first key is the most specific, and is purged whenever the
+        content is replaced or removed. The others let downstream caches be
+        purged by generator, or of every page showing a given post.
+        """
+        keys = [static.surrogate_key(cls.__name__, *args)]
+        if args:
+            keys.append(static.surrogate_key(cls.__name__))
+        return keys
+
     @classmethod
     def generate_resource(cls, post, resource):
         """(Re)generates a resource for the provided post.
@@ -88,21 +183,19 @@ class PostContentGenerator(ContentGenerator):
         return post.hash
 
     @classmethod
-    def get_prev_next(cls, post):
-        """Retrieves the chronologically previous and next post for this post"""
-        import models
-
-        q = models.BlogPost.all().order('-published')
-        q.filter('published !=', datetime.datetime.max)# Filter drafts out
-        q.filter('published <', post.published)
-        prev = q.get()
+    def get_surrogate_keys(cls, post):
+        return [static.surrogate_key('post', post.key().id()),
+                static.surrogate_key(PostContentGenerator.__name__)]
 
-        q = models.BlogPost.all().order('published')
-        q.filter('published !=', datetime.datetime.max)# Filter drafts out
-        q.filter('published >', post.published)
-        next = q.get()
+    @classmethod
+    def get_prev_next(cls, post):
+        """Retrieves the chronologically previous and next post for this post.
 
-        return prev,next
+        Both are dicts of the post's published, id, path and title, from the
+        timeline in models.
+        """
+        import models
+        return models.get_prev_next(post)
 
     @classmethod
     def generate_resource(cls, post, resource, action='post'):
@@ -126,7 +219,8 @@ class PostContentGenerator(ContentGenerator):
         if next:
             template_vals['next']=next
         rendered = utils.render_template('post.html', template_vals)
-        static.set(post.path, rendered, config.html_mime_type)
+        static.set(post.path, rendered, config.html_mime_type,
+                   surrogate_keys=cls.get_surrogate_keys(post))
 generator_list.append(PostContentGenerator)
 
 class PostPrevNextContentGenerator(PostContentGenerator):
@@ -135,7 +229,7 @@ class PostPrevNextContentGenerator(PostContentGenerator):
     @classmethod
     def get_resource_list(cls, post):
         prev, next = cls.get_prev_next(post)
-        resource_list = [res.key().id() for res in (prev,next) if res is not None]
+        resource_list = [res['id'] for res in (prev,next) if res is not None]
         return resource_list
 
     @classmethod
@@ -155,7 +249,8 @@ class PostPrevNextContentGenerator(PostContentGenerator):
         if next:
          template_vals['next']=next
         rendered = utils.render_template("post.html", template_vals)
-        static.set(post.path, rendered, config.html_mime_type)
+        static.set(post.path, rendered, config.html_mime_type,
+                   surrogate_keys=cls.get_surrogate_keys(post))
 generator_list.append(PostPrevNextContentGenerator)
 
 class ListingContentGenerator(ContentGenerator):
@@ -183,46 +278,81 @@ class ListingContentGenerator(ContentGenerator):
         pass
 
     @classmethod
-    def generate_resource(cls, post, resource, pagenum=1, start_ts=None):
-        """ Fetches a list of the N most recent blog posts, and renders the
-        listing.html template with them - storing the result to the root path
-        (or offset if not the first N posts).
-        
-        To clarify, the output of the listing template with the template values is
-        stored in the static store at a location whose key is this path.
-        """
+    def _query(cls, resource, cursor=None):
+        """Returns the query for the posts in a listing, newest first."""
         import models
         q = models.BlogPost.all().order('-published')
-        q.filter('published <', start_ts or datetime.datetime.max)
+        # Drafts have published == datetime.datetime.max.
+        q.filter('published <', datetime.datetime.max)
         cls._filter_query(resource, q)
+        if cursor:
+            q.with_cursor(cursor)
+        return q
 
-        posts = q.fetch(config.posts_per_page + 1)
-        more_posts = len(posts) > config.posts_per_page
+    @classmethod
+    def _page_path(cls, resource, pagenum):
+        path = cls.first_page_path if pagenum == 1 else cls.path
+        return path % {'resource': resource, 'pagenum': pagenum}
 
-        path_args = {
-                'resource': resource,
-        }
-        _get_path = lambda: \
-                                    cls.first_page_path if path_args['pagenum'] == 1 else cls.path
-        path_args['pagenum'] = pagenum - 1
-        prev_page = _get_path() % path_args
-        path_args['pagenum'] = pagenum + 1
-        next_page = cls.path % path_args
-             
-        template_vals = {
-                'generator_class': cls.__name__,
-                'posts': posts[:config.posts_per_page],
-                'prev_page': prev_page if pagenum > 1 else None,
-                'next_page': next_page if more_posts else None,
-        }
-        
-        rendered = utils.render_template('listing.html', template_vals)
+    @classmethod
+    @batching.batched
+    def generate_resource(cls, post, resource, pagenum=1, start_ts=None,
+                          cursor=None):
+        """ Renders the pages of a listing, config.posts_per_page posts to a
+        page, with the listing.html template - storing each to the root path
+        (or offset if not the first page).
+
+        The listing query is read once, through a cursor, and up to
+        config.listing_pages_per_task pages are rendered and stored together;
+        a further task is deferred for the rest. A page is only rendered if
+        its posts, their summaries or its neighbours changed since it was last
+        stored, or the app has been redeployed since.
+
+        start_ts is no longer used, but is still accepted from tasks queued by
+        older versions, which restart the listing from the first page.
+        """
+        if start_ts:
+            pagenum, cursor = 1, None
+        per_page = config.posts_per_page
+        q = cls._query(resource, cursor)
+        posts = q.fetch(per_page * config.listing_pages_per_task)
+        cursor = q.cursor()
+        more_posts = False
+        if len(posts) == per_page * config.listing_pages_per_task:
+            more_posts = cls._query(resource, cursor).get() is not None
+
+        pages = [posts[i:i + per_page] for i in range(0, len(posts), per_page)]
+        if not pages:
+            pages = [[]] # Listings always have a first page, even if empty.
+        for i, page_posts in enumerate(pages):
+            num = pagenum + i
+            has_next = i + 1 < len(pages) or more_posts
+            path = cls._page_path(resource, num)
+            source_hash = hashlib.sha1(repr((
+                    os.environ.get('CURRENT_VERSION_ID'),
+                    [(x.key().id(), x.summary_hash) for x in page_posts],
+                    has_next))).hexdigest()
+            existing = static.get(path)
+            if existing and existing.source_hash == source_hash:
+                continue
 
-        path_args['pagenum'] = pagenum
-        static.set(_get_path() % path_args, rendered, config.html_mime_type)
+            template_vals = {
+                    'generator_class': cls.__name__,
+                    'posts': page_posts,
+                    'prev_page': cls._page_path(resource, num - 1)
+                                 if num > 1 else None,
+                    'next_page': cls._page_path(resource, num + 1)
+                                 if has_next else None,
+            }
+            rendered = utils.render_template('listing.html', template_vals)
+            static.set(path, rendered, config.html_mime_type,
+                       source_hash=source_hash,
+                       surrogate_keys=cls.get_surrogate_keys(resource) +
+                           [static.surrogate_key('post', x.key().id())
+                            for x in page_posts])
         if more_posts:
-                deferred.defer(cls.generate_resource, None, resource, pagenum + 1,
-                                             posts[-2].published)
+            defer_generate(cls, None, resource, pagenum + len(pages), None,
+                           cursor)
 
 
 class IndexContentGenerator(ListingContentGenerator):
@@ -289,9 +419,53 @@ class ArchivePageContentGenerator(ListingContentGenerator):
 generator_list.append(ArchivePageContentGenerator)
 
 
+class ArchiveCountContentGenerator(ContentGenerator):
+    """Keeps the month counts in the Archive in step with each post.
+
+    The month a post has been counted under is kept in its archived_month,
+    so counting a post again (as a full regeneration does) changes nothing.
+    """
+
+    can_defer = False
+    updates_post = True
+
+    @classmethod
+    def get_resource_list(cls, post):
+        return [post.key().id()]
+
+    @classmethod
+    def get_etag(cls, post):
+        from models import BlogDate
+        return BlogDate.get_key_name(post)
+
+    @classmethod
+    def generate_resource(cls, post, resource, action='post'):
+        """ Moves the post's count to its current month. The caller saves the
+        post. """
+        import models
+        if not post:
+            post = models.BlogPost.get_by_id(resource)
+        else:
+            assert resource == post.key().id()
+        month = None
+        if action != 'delete':
+            month = models.BlogDate.get_key_name(post)
+        deltas = {}
+        if month:
+            deltas[month] = 1
+        if post.archived_month:
+            deltas[post.archived_month] = deltas.get(post.archived_month, 0) - 1
+        models.update_archive(deltas)
+        post.archived_month = month
+generator_list.append(ArchiveCountContentGenerator)
+
+
 class ArchiveIndexContentGenerator(ContentGenerator):
     """
     ContentGenerator for archive index (a list of year-month pairs).
+
+    It's rendered from the month counts in the Archive, and only stored again
+    when they change.
     """
 
     @classmethod
@@ -300,29 +474,51 @@ class ArchiveIndexContentGenerator(ContentGenerator):
 
     @classmethod
     def get_etag(cls, post):
-        return post.hash
+        # The index only changes with the month a post is in. Posts being
+        # published or removed regenerate it regardless.
+        from models import BlogDate
+        return BlogDate.get_key_name(post)
 
     @classmethod
     def generate_resource(cls, post, resource):
-        from models import BlogDate
+        from models import BlogDate, get_archive_months
 
-        q = BlogDate.all().order('-__key__')
-        dates = [x.date for x in q]
-        date_struct = {}
-        for date in dates:
-            date_struct.setdefault(date.year, []).append(date)
+        months = sorted(get_archive_months().items(), reverse=True)
+        source_hash = hashlib.sha1(repr((
+                os.environ.get('CURRENT_VERSION_ID'), months))).hexdigest()
+        existing = static.get('/archive/')
+        if existing and existing.source_hash == source_hash:
+            return
+
+        date_struct = []
+        for key_name, count in months:
+            date = BlogDate.datetime_from_key_name(key_name).date()
+            if not date_struct or date_struct[-1][0]['date'].year != date.year:
+                date_struct.append([])
+            date_struct[-1].append({'date': date, 'count': count})
             
         str = utils.render_template('archive.html', {
             'generator_class': cls.__name__,
-            'dates': dates,
-            'date_struct': date_struct.values(),
+            'date_struct': date_struct,
         })
-        static.set('/archive/', str, config.html_mime_type)
+        static.set('/archive/', str, config.html_mime_type,
+                   source_hash=source_hash,
+                   surrogate_keys=cls.get_surrogate_keys())
 generator_list.append(ArchiveIndexContentGenerator)
 
 
 class AtomContentGenerator(ContentGenerator):
-    """ContentGenerator for Atom feeds."""
+    """ContentGenerator for Atom feeds.
+
+    Each post's <entry> is rendered on its own and cached in memcache by a
+    hash of what it shows, so the feeds it appears in share it and a feed is
+    mostly assembled from cached entries.
+    """
+    path = '/feeds/atom.xml'
+    """The path for the feed."""
+
+    feed_title = None
+    """What the feed is of, added to the blog name in its title."""
 
     @classmethod
     def get_resource_list(cls, post):
@@ -332,29 +528,65 @@ class AtomContentGenerator(ContentGenerator):
     def get_etag(cls, post):
         return post.hash
 
+    @classmethod
+    def _filter_query(cls, resource, q):
+        """Applies filters to the BlogPost query, as for listings."""
+        pass
+
+    @classmethod
+    def get_entries(cls, posts):
+        """Returns the rendered Atom <entry> of each of posts."""
+        keys = []
+        for post in posts:
+            val = (post.key().id(), post.title, post.path, post.updated,
+                   post.published, post.original_author_name,
+                   post.current_render_key,
+                   os.environ.get('CURRENT_VERSION_ID'))
+            keys.append('atom-entry:' + hashlib.sha1(repr(val)).hexdigest())
+        cached = memcache.get_multi(keys)
+        rendered = {}
+        for key, post in zip(keys, posts):
+            if key not in cached:
+                rendered[key] = utils.render_template('atom_entry.xml',
+                                                      {'post': post})
+        if rendered:
+            memcache.set_multi(rendered)
+            cached.update(rendered)
+        return [cached[x] for x in keys]
+
     @classmethod
     def generate_resource(cls, post, resource):
         import models
-        q = models.BlogPost.all().order('-updated')
         # Fetch the 10 most recently updated non-draft posts
-        posts = list(itertools.islice((x for x in q if x.path), 10))
+        q = models.BlogPost.all().filter('is_published =', True)
+        cls._filter_query(resource, q)
+        posts = q.order('-updated').fetch(10)
         now = datetime.datetime.now().replace(second=0, microsecond=0)
+        path = cls.path % {'resource': resource}
         template_vals = {
                 'posts': posts,
+                'entries': ''.join(cls.get_entries(posts)),
                 'updated': now,
+                'feed_path': path,
+                # The site-wide feed keeps the id it always had.
+                'feed_id': path[len('/feeds/'):],
+                'feed_title': cls.feed_title and cls.feed_title % resource,
         }
         
         rendered = utils.render_template('atom.xml', template_vals)
-        static.set('/feeds/atom.xml', rendered,
+        static.set(path, rendered,
                              'application/atom+xml; charset=utf-8', indexed=False,
-                             last_modified=now)
+                             last_modified=now,
+                             surrogate_keys=cls.get_surrogate_keys(resource) +
+                                 [static.surrogate_key('post', x.key().id())
+                                  for x in posts])
         if config.hubbub_hub_url:
-            cls.send_hubbub_ping(config.hubbub_hub_url)
+            cls.send_hubbub_ping(config.hubbub_hub_url, path)
 
     @classmethod
-    def send_hubbub_ping(cls, hub_url):
+    def send_hubbub_ping(cls, hub_url, path='/feeds/atom.xml'):
         data = urllib.urlencode({
-                'hub.url': 'http://%s/feeds/atom.xml' % (config.host,),
+                'hub.url': 'http://%s%s' % (config.host, path),
                 'hub.mode': 'publish',
         })
         response = urlfetch.fetch(hub_url, data, urlfetch.POST)
@@ -362,6 +594,38 @@ class AtomContentGenerator(ContentGenerator):
             raise Exception('Hub ping failed', response.status_code, response.content)
 generator_list.append(AtomContentGenerator)
 
+
+class TagAtomContentGenerator(AtomContentGenerator):
+    """ContentGenerator for the Atom feed of each tag."""
+
+    path = '/feeds/tag/%(resource)s.xml'
+    feed_title = 'Posts tagged %s'
+
+    @classmethod
+    def get_resource_list(cls, post):
+        return post.normalized_tags
+
+    @classmethod
+    def _filter_query(cls, resource, q):
+        q.filter('normalized_tags =', resource)
+generator_list.append(TagAtomContentGenerator)
+
+
+class AuthorAtomContentGenerator(AtomContentGenerator):
+    """ContentGenerator for the Atom feed of each author's posts."""
+
+    path = '/feeds/author/%(resource)s.xml'
+    feed_title = 'Posts by %s'
+
+    @classmethod
+    def get_resource_list(cls, post):
+        return post.authors
+
+    @classmethod
+    def _filter_query(cls, resource, q):
+        q.filter('authors =', resource)
+generator_list.append(AuthorAtomContentGenerator)
+
 class PageContentGenerator(ContentGenerator):
     @classmethod
     def generate_resource(cls, page, resource, action='post'):
@@ -374,14 +638,72 @@ class PageContentGenerator(ContentGenerator):
             }
             rendered = utils.render_template('pages/%s' % (page.template,),
                                                                              template_vals)
-            static.set(page.path, rendered, config.html_mime_type)
+            static.set(page.path, rendered, config.html_mime_type,
+                       surrogate_keys=cls.get_surrogate_keys(page.path))
 
-class TagCloudContentGenerator(ContentGenerator):
-    """ContentGenerator for tag clouds.
-    @author Tom Allen
+class FragmentContentGenerator(ContentGenerator):
+    """A ContentGenerator for a fragment of the sidebar.
+
+    Fragments are stored under their name, which must also be listed in
+    static.SIDEBAR_FRAGMENTS, and are joined into every page as it is served,
+    so a fragment changing doesn't regenerate any pages.
+    """
+
+    fragment = None
+    """The name the fragment is stored under."""
+
+    generate_on_deploy = False
+    """If True, the fragment depends on no posts and is rendered on deploy."""
+
+    @classmethod
+    def get_resource_list(cls, post):
+        return []
+
+    @classmethod
+    def get_etag(cls, post):
+        return None
+
+    @classmethod
+    def store_fragment(cls, rendered, **kwargs):
+        # Fragments aren't served themselves, but purging the sidebar key
+        # purges every page they appear on.
+        static.set(cls.fragment, rendered, config.html_mime_type, indexed=False,
+                   surrogate_keys=[static.SIDEBAR_KEY], **kwargs)
+
+    @classmethod
+    def generate_resource(cls, post, resource):
+        cls.store_fragment(utils.render_template('%s.html' % (cls.fragment,)))
+
+
+def cloud_font_sizes(counts):
+    """Returns a dict mapping each key of counts to its font size in a cloud.
+
+    Sizes are in em, from config.tag_cloud_min_fontsize to
+    config.tag_cloud_max_fontsize on a log scale, rounded.
+    """
+    if not counts:
+        return {}
+    from math import log
+    min_count = min(counts.values())
+    max_count = max(counts.values())
+    c = log( max_count - (min_count-1) ) / (config.tag_cloud_max_fontsize - config.tag_cloud_min_fontsize or 1) # scaling constant
+    c = c or 1 # Avoid div by zero if min and max are equal.
+    sizes = {}
+    for key, count in counts.items():
+        size = log( count - (min_count-1) ) / c + config.tag_cloud_min_fontsize
+        sizes[key] = round(size)
+    return sizes
+
+
+class TagCountContentGenerator(ContentGenerator):
+    """Keeps the tag counts in step with the tags of each post.
+
+    The tags a post has been counted under are kept in its counted_tags, so
+    counting a post again (as a full regeneration does) changes nothing.
     """
-    
+
     can_defer = False
+    updates_post = True
 
     @classmethod
     def get_resource_list(cls, post):
@@ -394,63 +716,169 @@ class TagCloudContentGenerator(ContentGenerator):
         return post.tags_hash # Uses tags only to generate the hash.
 
     @classmethod
-    def generate_resource(cls, post, resource):
-        """ Updates the counts for each tag in a given post. """
+    def generate_resource(cls, post, resource, action='post'):
+        """ Updates the counts for each tag added to or removed from a post.
+        The caller saves the post. """
         import models
         # resource is the ID of the post.
         if not post:
             post = models.BlogPost.get_by_id(resource)
         else:
             assert resource == post.key().id()
-        
-        import logging
-        for tag in post.normalized_tags:
-            logging.debug('TagCloudContentGenerator.generate_resource in generators.py, tag = ' + tag)
-            tag_counter = models.TagCounter.get_by_key_name( key_names=str(tag) )
-            if not tag_counter:
-                tag_counter = models.TagCounter(key_name=str(tag), tagname=str(tag), tagcount=0)
-            tag_counter.tagcount += 1
-            tag_counter.put()
- 
-        # Build triples of (tag, url, count) by extract the 'tag_cloud_max_size' most popular tags.     
-        q = models.TagCounter.all().order('-tagcount')
-        tags_and_counts = list(itertools.islice((x.tag_and_count for x in q if x.tagcount != 0), config.tag_cloud_max_size))
-        
-        # Calculate font sizes for tags
-        from math import log
-        tags_and_counts_dict=dict(tags_and_counts)
-        logging.debug('TagCloudContentGenerator.generate_resource in generators.py, tags_and_counts_dict = ' + str(tags_and_counts_dict))
-        min_count = min(tags_and_counts_dict.values())
-        max_count = max(tags_and_counts_dict.values())
-        c = log( max_count - (min_count-1) ) / (config.tag_cloud_max_fontsize - config.tag_cloud_min_fontsize or 1) # scaling constant
-        c = c or 1 # Avoid div by zero if min and max are equal.
-        logging.debug('TagCloudContentGenerator.generate_resource in generators.py, min_count = ' + str(min_count) + ', max_count = ' + str(max_count) + ', c = ' + str(c))
+        tags = []
+        if action != 'delete':
+            tags = post.normalized_tags
+        deltas = {}
+        for tag in tags:
+            deltas[tag] = deltas.get(tag, 0) + 1
+        for tag in post.counted_tags:
+            deltas[tag] = deltas.get(tag, 0) - 1
+        models.update_tag_counts(deltas)
+        post.counted_tags = list(tags)
+        if [x for x in deltas.values() if x]:
+            mark_dirty(TagCloudContentGenerator, None)
+generator_list.append(TagCountContentGenerator)
+
+
+class TagCloudContentGenerator(FragmentContentGenerator):
+    """ContentGenerator for tag clouds.
+
+    The fragment is only stored again when the tags shown in it or their font
+    sizes change, not whenever a count does.
+    @author Tom Allen
+    """
+
+    fragment = 'tagcloud'
+    generate_on_deploy = True
+
+    @classmethod
+    def generate_resource(cls, post, resource):
+        """ Renders the 'tag_cloud_max_size' most popular tags. """
+        import models
+        counts = models.get_tag_counts()
+        tags_and_counts = heapq.nlargest(config.tag_cloud_max_size,
+                                         counts.items(), key=lambda x: x[1])
+
+        sizes = cloud_font_sizes(dict(tags_and_counts))
         tagcloud = []
-        for tag_name, tag_count in tags_and_counts_dict.items():
-            size = log( tag_count - (min_count-1) ) / c + config.tag_cloud_min_fontsize
-            tagcloud.append({'tag':tag_name, 'url':tag_name, 'count':tag_count, 'fontsize':round(size)})
-        
+        for tag_name, tag_count in sorted(tags_and_counts):
+            tagcloud.append({'tag':tag_name, 'url':tag_name, 'count':tag_count, 'fontsize':sizes[tag_name]})
+
+        source_hash = hashlib.sha1(repr((
+                os.environ.get('CURRENT_VERSION_ID'),
+                [(x['tag'], x['fontsize']) for x in tagcloud]))).hexdigest()
+        existing = static.get(cls.fragment)
+        if existing and existing.source_hash == source_hash:
+            return
+
         # Pass these tag pairs and counts as template variables to the tag cloud template.
         template_vals = {
             'tagcloud': tagcloud,
         }        
         rendered = utils.render_template('tagcloud.html', template_vals)
         
-        # Store the tagcloud HTML in the static store undrthe path 'tagcloud'.
-        static.set('tagcloud', rendered, config.html_mime_type, indexed=False)
-generator_list.append(TagCloudContentGenerator)
+        cls.store_fragment(rendered, source_hash=source_hash)
+fragment_list.append(TagCloudContentGenerator)
+
+class AuthorCountContentGenerator(ContentGenerator):
+    """Keeps the postscount of each author's UserPrefs in step with the posts.
+
+    The authors a post has been counted under are kept in its
+    counted_authors, so counting a post again changes nothing.
+    """
+
+    can_defer = False
+    updates_post = True
+
+    @classmethod
+    def get_resource_list(cls, post):
+        return [post.key().id()]
+
+    @classmethod
+    def get_etag(cls, post):
+        return ','.join(post.authors)
+
+    @classmethod
+    def generate_resource(cls, post, resource, action='post'):
+        """ Updates the counts of each author added to or removed from a post.
+        The caller saves the post. """
+        import models
+        if not post:
+            post = models.BlogPost.get_by_id(resource)
+        else:
+            assert resource == post.key().id()
+        authors = []
+        if action != 'delete':
+            authors = post.authors
+        deltas = {}
+        for author in authors:
+            deltas[author] = deltas.get(author, 0) + 1
+        for author in post.counted_authors:
+            deltas[author] = deltas.get(author, 0) - 1
+        models.update_author_counts(deltas)
+        post.counted_authors = list(authors)
+        if [x for x in deltas.values() if x]:
+            mark_dirty(AuthorCloudContentGenerator, None)
+generator_list.append(AuthorCountContentGenerator)
+
+
+class AuthorCloudContentGenerator(FragmentContentGenerator):
+    """ContentGenerator for the author cloud, of the authors with most posts.
+
+    Like the tag cloud, it's only stored again when the authors shown or
+    their font sizes change.
+    """
+
+    fragment = 'authorcloud'
+    generate_on_deploy = True
+
+    @classmethod
+    def generate_resource(cls, post, resource):
+        import models
+        q = models.UserPrefs.all().filter('postscount >', 0).order('-postscount')
+        authors = dict((x.namepath.lstrip('/'), (x.name, x.postscount))
+                       for x in q.fetch(config.author_cloud_max_size)
+                       if x.namepath)
+        sizes = cloud_font_sizes(dict((k, v[1]) for k, v in authors.items()))
+        authorcloud = []
+        for author in sorted(authors, key=lambda x: authors[x][0].lower()):
+            name, count = authors[author]
+            authorcloud.append({'name': name, 'url': author, 'count': count,
+                                'fontsize': sizes[author]})
+
+        source_hash = hashlib.sha1(repr((
+                os.environ.get('CURRENT_VERSION_ID'),
+                [(x['name'], x['url'], x['fontsize']) for x in authorcloud]))).hexdigest()
+        existing = static.get(cls.fragment)
+        if existing and existing.source_hash == source_hash:
+            return
+        rendered = utils.render_template('authorcloud.html',
+                                         {'authorcloud': authorcloud})
+        cls.store_fragment(rendered, source_hash=source_hash)
+fragment_list.append(AuthorCloudContentGenerator)
+
+class SidebarsContentGenerator(FragmentContentGenerator):
+    """ContentGenerator for the sidebars listed in config.sidebars."""
+
+    fragment = 'sidebars'
+    generate_on_deploy = True
+fragment_list.append(SidebarsContentGenerator)
 
 class AuthorsContentGenerator(ListingContentGenerator):
-    """ContentGenerator for the authors pages."""
+    """ContentGenerator for the authors pages.
+
+    Authors are identified by their UserPrefs namepath, without the leading
+    '/'. A post is listed under its original author and its editors.
+    """
 
     path = '/author/%(resource)s/%(pagenum)d'
     first_page_path = '/author/%(resource)s'
 
     @classmethod
     def get_resource_list(cls, post):
-        return post.normalized_original_author_name
+        return post.authors
 
     @classmethod
     def _filter_query(cls, resource, q):
-        q.filter('normalized_original_author_name =', resource)
-#generator_list.append(AuthorsContentGenerator)
+        q.filter('authors =', resource)
+generator_list.append(AuthorsContentGenerator)
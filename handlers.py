@@ -46,17 +46,15 @@ def with_post(fun):
 
 class BaseHandler(webapp.RequestHandler):
     def render_to_response(self, template_name, template_vals=None, theme=None):
-        from google.appengine.ext import db
         if not template_vals:
             template_vals = {}
         # User must be an admin to reach this handler.
         loginout_url = users.create_logout_url(self.request.uri)
         url_linktext = 'Logout'
-        q = db.GqlQuery('SELECT * FROM UserPrefs WHERE user = :1', users.get_current_user())
-        userprefs = q.get()
+        identity = models.get_identity(users.get_current_user())
         user_name = users.get_current_user().nickname() # Default to email if we can't find the user prefs, but this shouldn't actually happen...
-        if userprefs:
-                user_name = userprefs.name
+        if identity['name'] is not None:
+                user_name = identity['name']
 
         template_vals.update({
                 'path': self.request.path,
@@ -117,7 +115,6 @@ class PostHandler(BaseHandler):
         creating a new entity. It then calls .publish() on the new BlogPost
         entity. """
         
-        from google.appengine.ext import db
         form = PostForm(data=self.request.POST, instance=post,
                                         initial={'draft': post and post.published is None})
         if form.is_valid():
@@ -125,27 +122,28 @@ class PostHandler(BaseHandler):
             if form.clean_data['draft']:# Draft post
                 post.published = datetime.datetime.max
                 post.put()
+                if post.path:
+                    # It was published before, so stop counting and listing it.
+                    post.unpublish()
             else:
                 if not post.path: # Publish post
                     post.updated = post.published = datetime.datetime.now()
                     post.original_author_as_user = users.get_current_user() # Only assign the original user on first save of non-draft post.
                     # Find this user's name string
-                    q = db.GqlQuery('SELECT * FROM UserPrefs WHERE user = :1', post.original_author_as_user)
-                    userprefs = q.get()
-                    if userprefs:
-                        post.original_author_name = userprefs.name # Set user name string for this post.
+                    user_name = models.get_identity(post.original_author_as_user)['name']
+                    if user_name is not None:
+                        post.original_author_name = user_name # Set user name string for this post.
                     logging.info('PostHandler.post in handlers.py, original_author_name = ' + str(post.original_author_name))
                 else:# Edit post
                     post.updated = datetime.datetime.now()
                     # Find this user's name string
-                    q = db.GqlQuery('SELECT * FROM UserPrefs WHERE user = :1', users.get_current_user())
-                    userprefs = q.get()
+                    user_name = models.get_identity(users.get_current_user())['name']
                     # Add additional authors to editors list, provided they aren't the
                     # original author, and aren't already in the list.
                     logging.info('PostHandler.post in handlers.py, editors started = %s' % str(post.editors))
-                    if userprefs and userprefs.name != post.original_author_name \
-                                             and userprefs.name not in post.editors:
-                        post.editors.append( userprefs.name )
+                    if user_name is not None and user_name != post.original_author_name \
+                                             and user_name not in post.editors:
+                        post.editors.append( user_name )
                     logging.info('PostHandler.post in handlers.py, editors finished = %s' % str(post.editors))
                 post.put()
                 post.publish()
@@ -181,8 +179,10 @@ class PreviewHandler(BaseHandler):
 
 class RegenerateHandler(BaseHandler):
     def post(self):
-        deferred.defer(post_deploy.TagCloudRegenerator().regenerate) # Added by Tom.
-        deferred.defer(post_deploy.PostRegenerator().regenerate)
+        # Posts are regenerated once their tags are recounted, as both
+        # record what they have counted on each post.
+        deferred.defer(post_deploy.TagCloudRegenerator(
+            post_deploy.PostRegenerator()).regenerate)
         deferred.defer(post_deploy.PageRegenerator().regenerate)
         deferred.defer(post_deploy.try_post_deploy, force=True)
         self.render_to_response('regenerating.html')
@@ -39,6 +39,10 @@ from docutils.core import publish_parts
 
 CUT_SEPARATOR_REGEX = r'<!--.*cut.*-->'
 
+# Rendered posts are stored with this, so bump it whenever a renderer changes
+# its output to have posts rendered again.
+RENDERER_VERSION = 1
+
 
 def render_rst(content):
     warning_stream = StringIO()
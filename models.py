@@ -1,10 +1,17 @@
+# If your app fails to import aetycoon during development testing, you have
+# most likely forgotten to init and update git submodules.
 import aetycoon
+import bisect
 import datetime
 import hashlib
+import random
 import re
+import time
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
+import batching
 import config
 import generators
 import markup
@@ -19,18 +26,15 @@ else:
 
 
 class BlogDate(db.Model):
-    """Contains a list of year-months for published blog posts."""
+    """Contains a list of year-months for published blog posts.
+
+    These are no longer stored; the months are counted in the Archive.
+    """
 
     @classmethod
     def get_key_name(cls, post):
         return '%d/%02d' % (post.published_tz.year, post.published_tz.month)
 
-    @classmethod
-    def create_for_post(cls, post):
-        inst = BlogDate(key_name=BlogDate.get_key_name(post))
-        inst.put()
-        return inst
-
     @classmethod
     def datetime_from_key_name(cls, key_name):
         year, month = key_name.split('/')
@@ -56,6 +60,22 @@ class BlogPost(db.Model):
     original_author_name = db.StringProperty() # User name string for original author
     editors = db.StringListProperty() # User name strings for subsequent editors
     locked = db.BooleanProperty(default=True) # Determines whether the post is locked from being edited. Defaults to true.
+    # The tags this post has been counted under in the TagCounters.
+    counted_tags = db.StringListProperty(indexed=False)
+    # The month this post has been counted under in the Archive.
+    archived_month = db.StringProperty(indexed=False)
+    # The namepaths, without the leading '/', of the original author and the
+    # editors, as set by update_authors.
+    authors = db.StringListProperty()
+    # The authors whose postscount this post has been counted in.
+    counted_authors = db.StringListProperty(indexed=False)
+    # The body and summary rendered to HTML, valid while render_key matches
+    # the post's current render_key.
+    rendered_body = db.TextProperty()
+    rendered_summary = db.TextProperty()
+    render_key = db.StringProperty(indexed=False)
+    # The year of the Timeline this post is in, if any.
+    timeline_year = db.IntegerProperty(indexed=False)
 
     @property
     def published_tz(self):
@@ -69,22 +89,65 @@ class BlogPost(db.Model):
     def normalized_tags(tags):
         return list(set(utils.slugify(x.lower()) for x in tags))
     
-    def normalized_original_author_name(self):
-        return utils.slugify(original_author_name.lower())
+    @aetycoon.DerivedProperty
+    def is_published(self):
+        """True for published posts, so they can be queried by updated."""
+        return bool(self.path) and self.published != datetime.datetime.max
+
+    def update_authors(self):
+        """Sets authors from the UserPrefs of the original author and editors."""
+        authors = []
+        if self.original_author_as_user:
+            namepath = get_identity(self.original_author_as_user)['namepath']
+            if namepath:
+                authors.append(namepath.lstrip('/'))
+        for name in self.editors:
+            prefs = UserPrefs.all().filter('name =', name).get()
+            if prefs and prefs.namepath:
+                author = prefs.namepath.lstrip('/')
+                if author not in authors:
+                    authors.append(author)
+        self.authors = authors
 
     @property
     def tag_pairs(self):
         return [(x, utils.slugify(x.lower())) for x in self.tags]
 
+    @property
+    def current_render_key(self):
+        """Hash of everything the rendered body and summary depend on."""
+        val = (self.body, self.body_markup, markup.RENDERER_VERSION,
+               config.summary_length)
+        return hashlib.sha1(repr(val)).hexdigest()
+
+    def _render(self):
+        """Renders the body and summary, unless they are already stored.
+
+        They are only saved with the post the next time it is put().
+        """
+        render_key = self.current_render_key
+        if self.render_key != render_key:
+            body, summary = markup.render_body(self), markup.render_summary(self)
+            # Some renderers, like textile, return UTF-8 encoded strings.
+            if isinstance(body, str):
+                body = body.decode('utf-8')
+            if isinstance(summary, str):
+                summary = summary.decode('utf-8')
+            self.rendered_body = db.Text(body)
+            self.rendered_summary = db.Text(summary)
+            self.render_key = render_key
+
     @property
     def rendered(self):
         """Returns the rendered body."""
-        return markup.render_body(self)
+        self._render()
+        return self.rendered_body
 
     @property
     def summary(self):
         """Returns a summary of the blog post."""
-        return markup.render_summary(self)
+        self._render()
+        return self.rendered_summary
 
     @property
     def hash(self):
@@ -103,26 +166,23 @@ class BlogPost(db.Model):
         val = (self.tags)
         return hashlib.sha1(str(val)).hexdigest()
 
+    @batching.batched
     def publish(self):
         regenerate = False
         if not self.path:
-            num = 0
-            content = None
-            while not content:
-                """ Tries to find a unique URL for this post, and adds the content
-                to the datastore when it finds one. """
-                path = utils.format_post_path(self, num)
-                content = static.add(path, '', config.html_mime_type)
-                num += 1
-            self.path = path
+            # Find a unique URL for this post, and add placeholder content
+            # there to claim it.
+            content = static.add_unique(
+                lambda num: utils.format_post_path(self, num),
+                '', config.html_mime_type)
+            self.path = content.key().name()
             self.put()
             # Force regenerate on new publish. Also helps with generation of
             # chronologically previous and next page.
             regenerate = True
 
-        # Create BlogDate and TagCounter objects given the data for this post.
-        BlogDate.create_for_post(self)
-        TagCounter.create_for_post(self)
+        update_timeline(self)
+        self.update_authors()
 
         """ For every type of generated content (indexes, tags, etc) dependent
         upon this particular post:
@@ -140,8 +200,8 @@ class BlogPost(db.Model):
         
         Later edit: The only change here is that we check if the ContentGenerator
         permits deferred execution. If it doesn't, we execute generate_resource
-        as normal, but if it does, we call deferred.defer for each changed
-        dependency.
+        as normal, but if it does, we call generators.mark_dirty for each
+        changed dependency, which coalesces repeated changes.
         
         (Some of this sequence is now encapsulated in other functions, but it's
         doing roughly the same thing still.)
@@ -149,25 +209,52 @@ class BlogPost(db.Model):
         for generator_class, deps in self.get_deps(regenerate=regenerate):
             for dep in deps:
                 if generator_class.can_defer:
-                    deferred.defer(generator_class.generate_resource, None, dep)
+                    generators.mark_dirty(generator_class, dep)
                 else:
                     generator_class.generate_resource(self, dep)
         self.put()
 
+    @batching.batched
+    def unpublish(self):
+        """Takes a post that was published, and has just been saved as a
+        draft, out of the timeline, the counts and the listings. Its own page
+        stays until it's published again.
+        """
+        update_timeline(self, remove=True)
+        if not self.deps:
+            self.deps = {}
+        for generator_class in generators.generator_list:
+            # Forgetting the deps makes publishing the post again count and
+            # list it afresh.
+            old_deps, old_etag = self.deps.pop(generator_class.name(),
+                                               (set(), None))
+            deps = old_deps | set(generator_class.get_resource_list(self))
+            for dep in deps:
+                if generator_class.updates_post:
+                    generator_class.generate_resource(self, dep, action='delete')
+                elif generator_class.can_defer:
+                    generators.mark_dirty(generator_class, dep)
+        self.put()
+
+    @batching.batched
     def remove(self):
         if not self.is_saved():
             return
+        # Neighbours are still found by where the post was in the timeline.
+        update_timeline(self, remove=True)
         # It is important that the get_deps() return the post dependency
         # before the list dependencies as the BlogPost entity gets deleted
         # while calling PostContentGenerator.
         for generator_class, deps in self.get_deps(regenerate=True):
             for dep in deps:
                 if generator_class.can_defer:
-                    deferred.defer(generator_class.generate_resource, None, dep)
+                    generators.mark_dirty(generator_class, dep)
                 else:
                     if generator_class.name() == 'PostContentGenerator':
                         generator_class.generate_resource(self, dep, action='delete')
                         self.delete()
+                    elif generator_class.updates_post:
+                        generator_class.generate_resource(self, dep, action='delete')
                     else:
                         generator_class.generate_resource(self, dep)
 
@@ -187,6 +274,176 @@ class BlogPost(db.Model):
             self.deps[generator_class.name()] = (new_deps, new_etag)
             yield generator_class, to_regenerate
 
+
+def render_post(post):
+    """Renders the body and summary of post unless they are stored, and
+    returns (render_key, rendered_body, rendered_summary), so posts can be
+    rendered on an executor's pool and the results copied back."""
+    post._render()
+    return post.render_key, post.rendered_body, post.rendered_summary
+
+
+class Timeline(db.Model):
+    """The published posts of one year in chronological order.
+
+    entries is a sorted list of (published, id, path, title) tuples, so
+    neighbouring posts can be found by bisecting it rather than by querying.
+    There's one Timeline per year, so none grows past the entity size limit.
+    """
+    entries = aetycoon.PickleProperty()
+
+
+_TIMELINE_CACHE_KEY = 'timeline/%d'
+
+
+def _timeline_entry(post):
+    return (post.published, post.key().id(), post.path, post.title)
+
+
+def _year_range(year):
+    """Returns the datetimes (start, end) that bound the posts of a year."""
+    start = datetime.datetime(year, 1, 1)
+    if year == datetime.MAXYEAR:
+        return start, datetime.datetime.max
+    return start, datetime.datetime(year + 1, 1, 1)
+
+
+def get_timeline(year):
+    """Returns the timeline entries of a year, building its Timeline if there
+    is none."""
+    cache_key = _TIMELINE_CACHE_KEY % year
+    entries = memcache.get(cache_key)
+    if entries is not None:
+        return entries
+    key_name = str(year)
+    timeline = Timeline.get_by_key_name(key_name)
+    if not timeline:
+        start, end = _year_range(year)
+        q = BlogPost.all().order('published')
+        q.filter('published >=', start)
+        q.filter('published <', end) # Drafts are published at datetime.max
+        entries = []
+        posts = q.fetch(500)
+        while posts:
+            entries.extend(_timeline_entry(x) for x in posts if x.path)
+            q.with_cursor(q.cursor())
+            posts = q.fetch(500)
+        # A post published while this was built will have added itself.
+        timeline = Timeline.get_or_insert(key_name, entries=entries)
+    memcache.set(cache_key, timeline.entries)
+    return timeline.entries
+
+
+def _update_timeline_year(year, post, insert):
+    """Takes post out of the timeline of a year, and if insert is True puts it
+    back in where it now belongs."""
+    get_timeline(year) # Make sure there is one to update.
+    post_id = post.key().id()
+    def _tx():
+        timeline = Timeline.get_by_key_name(str(year))
+        entries = [x for x in timeline.entries if x[1] != post_id]
+        if insert:
+            bisect.insort(entries, _timeline_entry(post))
+        timeline.entries = entries
+        timeline.put()
+    db.run_in_transaction(_tx)
+    memcache.delete(_TIMELINE_CACHE_KEY % year)
+
+
+def update_timeline(post, remove=False):
+    """Adds, moves or (if remove is True) removes post in the timeline.
+
+    A post that isn't published, such as one saved as a draft, is removed.
+    The year post is filed under is kept in its timeline_year, so it can be
+    taken out of that year's Timeline when it moves; the caller saves the
+    post.
+    """
+    year = None
+    if not remove and post.is_published:
+        year = post.published.year
+        _update_timeline_year(year, post, True)
+    if post.timeline_year and post.timeline_year != year:
+        _update_timeline_year(post.timeline_year, post, False)
+    post.timeline_year = year
+
+
+def get_prev_next(post):
+    """Returns the timeline entries before and after post, as dicts.
+
+    Either is None if post is the first or last. post need not be in the
+    timeline itself. Neighbours in other years are found by querying.
+    """
+    entries = get_timeline(post.published.year)
+    post_id = post.key().id()
+    i = bisect.bisect_left(entries, (post.published, post_id))
+    j = i
+    if j < len(entries) and entries[j][1] == post_id:
+        j += 1
+    start, end = _year_range(post.published.year)
+    prev_entry = next_entry = None
+    if i > 0:
+        prev_entry = entries[i - 1]
+    else:
+        q = BlogPost.all().order('-published')
+        q.filter('published <', start)
+        prev_post = q.get()
+        if prev_post:
+            prev_entry = _timeline_entry(prev_post)
+    if j < len(entries):
+        next_entry = entries[j]
+    elif end < datetime.datetime.max:
+        q = BlogPost.all().order('published')
+        q.filter('published >=', end)
+        q.filter('published <', datetime.datetime.max) # Filter drafts out
+        next_post = q.get()
+        if next_post:
+            next_entry = _timeline_entry(next_post)
+    keys = ('published', 'id', 'path', 'title')
+    if prev_entry:
+        prev_entry = dict(zip(keys, prev_entry))
+    if next_entry:
+        next_entry = dict(zip(keys, next_entry))
+    return prev_entry, next_entry
+
+
+class Archive(db.Model):
+    """The number of published posts in each month, kept in one entity.
+
+    months maps each BlogDate key name, like '2010/05', to its count.
+    """
+    months = aetycoon.PickleProperty()
+
+
+ARCHIVE_KEY_NAME = 'archive'
+
+
+def get_archive_months():
+    """Returns a dict of BlogDate key name: number of posts that month."""
+    archive = Archive.get_by_key_name(ARCHIVE_KEY_NAME)
+    return (archive and archive.months) or {}
+
+
+def update_archive(deltas):
+    """Adds to the month counts, given a dict of month: change in count."""
+    deltas = dict((k, v) for k, v in deltas.items() if v)
+    if not deltas:
+        return
+    def _tx():
+        archive = Archive.get_by_key_name(ARCHIVE_KEY_NAME)
+        if not archive:
+            archive = Archive(key_name=ARCHIVE_KEY_NAME, months={})
+        months = dict(archive.months or {})
+        for month, delta in deltas.items():
+            count = months.get(month, 0) + delta
+            if count > 0:
+                months[month] = count
+            else:
+                months.pop(month, None)
+        archive.months = months
+        archive.put()
+    db.run_in_transaction(_tx)
+
+
 class Page(db.Model):
     # The URL path to the page.
     path = db.StringProperty(required=True)
@@ -227,43 +484,181 @@ class VersionInfo(db.Model):
         return (self.bloggart_major, self.bloggart_minor, self.bloggart_rev)
 
 class TagCounter(db.Model):
+    """One shard of the number of published posts with a tag.
+
+    Each shard is a child of one of config.tag_counter_shards parent keys,
+    so all the tags of a post are counted in a single transaction on one
+    randomly chosen shard.
+    """
     tagname = db.StringProperty(required=True)
     tagcount = db.IntegerProperty(required=True, default=0)
 
     @property
     def tag_and_count(self):
             return (utils.slugify(self.tagname.lower()), self.tagcount)
-            
-    @classmethod
-    def create_for_post(cls, post):
-        import logging
-        for tag in post.normalized_tags:
-            logging.debug('TagCounter.create_for_post in models.py, tag = ' + tag)
-            inst = TagCounter.get_by_key_name(key_names=str(tag))
-            if not inst:
-                inst = TagCounter(key_name=str(tag), tagname=str(tag), tagcount=0)
-            inst.tagcount += 1
-            inst.put()
-            
+
+
+class TagTotals(db.Model):
+    """The number of published posts with each tag, kept in one entity, so
+    the tag cloud needn't read every TagCounter shard.
+
+    counts maps each tag to its total, which each change to the shards is
+    added to in a transaction of its own.
+    """
+    counts = aetycoon.PickleProperty()
+
+
+TAG_TOTALS_KEY_NAME = 'tags'
+
+# Most tags counted in one transaction on a shard.
+TAG_BATCH_SIZE = 100
+
+
+def update_tag_counts(deltas):
+    """Adds to the tag counts, given a dict of tag: change in count."""
+    tags = sorted(x for x in deltas if deltas[x])
+    for i in range(0, len(tags), TAG_BATCH_SIZE):
+        _update_tag_shard(tags[i:i + TAG_BATCH_SIZE], deltas)
+    _update_tag_totals(dict((x, deltas[x]) for x in tags))
+
+
+def _update_tag_shard(tags, deltas):
+    """Adds the deltas for tags to the counters of one random shard."""
+    parent = db.Key.from_path(
+        'TagCounterShard', 'shard%d' % random.randrange(config.tag_counter_shards))
+    def _tx():
+        key_names = ['tag:' + x for x in tags]
+        counters = TagCounter.get_by_key_name(key_names, parent=parent)
+        for i, tag in enumerate(tags):
+            if not counters[i]:
+                counters[i] = TagCounter(key_name=key_names[i], parent=parent,
+                                         tagname=tag)
+            counters[i].tagcount += deltas[tag]
+        db.put(counters)
+    db.run_in_transaction(_tx)
+
+
+def _update_tag_totals(deltas):
+    """Adds to the TagTotals, given a dict of tag: change in count."""
+    if not deltas:
+        return
+    def _tx():
+        entity = TagTotals.get_by_key_name(TAG_TOTALS_KEY_NAME)
+        if not entity:
+            entity = TagTotals(key_name=TAG_TOTALS_KEY_NAME, counts={})
+        counts = dict(entity.counts or {})
+        for tag, delta in deltas.items():
+            count = counts.get(tag, 0) + delta
+            if count > 0:
+                counts[tag] = count
+            else:
+                counts.pop(tag, None)
+        entity.counts = counts
+        entity.put()
+    db.run_in_transaction(_tx)
+
+
+def get_tag_counts():
+    """Returns a dict mapping each tag in use to its number of posts."""
+    entity = TagTotals.get_by_key_name(TAG_TOTALS_KEY_NAME)
+    return (entity and entity.counts) or {}
+
+
+def reset_tag_counts():
+    """Deletes every tag count, for the tags to be counted again."""
+    q = TagCounter.all(keys_only=True)
+    keys = q.fetch(500)
+    while keys:
+        db.delete(keys)
+        q.with_cursor(q.cursor())
+        keys = q.fetch(500)
+    db.delete(TagTotals.all(keys_only=True))
+
 class UserPrefs(db.Model):
+    """A user's profile, keyed by their user id."""
     user = db.UserProperty()
     name = db.StringProperty()
     postscount = db.IntegerProperty(required=True, default=0)
     namepath = db.StringProperty() # Unique URL path made from name + a number if necessary.
 
+    @classmethod
+    def get_for_user(cls, user):
+        """Returns the UserPrefs for user, or None if they have none."""
+        prefs = cls.get_by_key_name(user.user_id())
+        if not prefs:
+            # Profiles saved before UserPrefs were keyed by user id.
+            prefs = cls.all().filter('user =', user).get()
+        return prefs
+
+    def put(self):
+        key = super(UserPrefs, self).put()
+        forget_identity(self.user)
+        return key
+
     @property
     def name_and_count(self):
-        return (namepath, self.postscount)
+        return (self.namepath, self.postscount)
 
     def publish(self):
         if not self.namepath:
-            num = 0
-            content = None
-            while not content:
-                """ Tries to find a unique URL for this user, and adds the content
-                to the datastore when it finds one. """
-                path = utils.format_user_path(self, num)
-                content = static.add(path, '', config.html_mime_type)
-                num += 1
-            self.namepath = path
+            # Find a unique URL for this user, and add placeholder content
+            # there to claim it.
+            content = static.add_unique(
+                lambda num: utils.format_user_path(self, num),
+                '', config.html_mime_type)
+            self.namepath = content.key().name()
             self.put()
+
+
+def update_author_counts(deltas):
+    """Adds to authors' postscount, given a dict of author: change in count.
+
+    Authors are namepaths without the leading '/', as in BlogPost.authors.
+    """
+    for author, delta in deltas.items():
+        if not delta:
+            continue
+        key = UserPrefs.all(keys_only=True).filter('namepath =', '/' + author).get()
+        if not key:
+            continue
+        def _tx():
+            prefs = UserPrefs.get(key)
+            prefs.postscount = max(0, prefs.postscount + delta)
+            prefs.put()
+        db.run_in_transaction(_tx)
+
+
+# Identities cached in this instance, as user id: (expiry time, identity).
+_identities = {}
+
+
+def get_identity(user):
+    """Returns a dict with the 'name' and 'namepath' from user's UserPrefs.
+
+    Both are None if the user has no UserPrefs yet. Identities are cached in
+    memcache, and in the instance for config.identity_cache_ttl seconds.
+    """
+    key = 'identity:' + user.user_id()
+    now = time.time()
+    cached = _identities.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    identity = memcache.get(key)
+    if identity is None:
+        prefs = UserPrefs.get_for_user(user)
+        identity = {
+            'name': prefs and prefs.name,
+            'namepath': prefs and prefs.namepath,
+        }
+        memcache.set(key, identity)
+    if len(_identities) >= config.identity_cache_size:
+        _identities.clear()
+    _identities[key] = (now + config.identity_cache_ttl, identity)
+    return identity
+
+
+def forget_identity(user):
+    """Drops the cached identity of user, after their UserPrefs change."""
+    key = 'identity:' + user.user_id()
+    _identities.pop(key, None)
+    memcache.delete(key)
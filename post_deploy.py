@@ -2,9 +2,11 @@ import datetime
 import logging
 import os
 from google.appengine.api import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import deferred
 
 import config
+import executors
 import models
 import static
 import utils
@@ -12,12 +14,13 @@ import generators
 
 # FIXME: Does managing this information as a tuple make sense when it always
 # has to be explcitly separated into its elements across function calls?
-BLOGGART_VERSION = (1, 0, 1)
+BLOGGART_VERSION = (1, 0, 8)
 
 
 class PostRegenerator(object):
-    def __init__(self):
+    def __init__(self, executor=None):
         self.seen = set()
+        self.executor = executor or executors.TaskQueueExecutor()
 
     def regenerate(self, batch_size=50, start_ts=None):
         """
@@ -30,20 +33,36 @@ class PostRegenerator(object):
         # as a sentinel value for drafts.
         q.filter('published <', start_ts or datetime.datetime.max)
         posts = q.fetch(batch_size)
+        # Render markup up front, in parallel on local executors, as the
+        # etags get_deps() compares depend on the rendered summaries.
+        stale = [x for x in posts if x.render_key != x.current_render_key]
+        rendered = self.executor.map(models.render_post, stale)
+        for post, fields in zip(stale, rendered):
+            if fields:
+                (post.render_key, post.rendered_body,
+                 post.rendered_summary) = fields
         for post in posts:
+            post.update_authors()
+            if post.timeline_year is None:
+                # Timelines are built from the posts' dates, so it's in this.
+                post.timeline_year = post.published.year
             for generator_class, deps in post.get_deps(True):
                 for dep in deps:
-                    if (generator_class.__name__, dep) not in self.seen:
+                    if generator_class.updates_post:
+                        # Records what it counted on post, saved below.
+                        generator_class.generate_resource(post, dep)
+                    elif (generator_class.__name__, dep) not in self.seen:
                         logging.warn((generator_class.__name__, dep))
                         self.seen.add((generator_class.__name__, dep))
-                        deferred.defer(generator_class.generate_resource, None, dep)
+                        self.executor.mark_dirty(generator_class, dep)
             post.put()
         if len(posts) == batch_size:
-            deferred.defer(self.regenerate, batch_size, posts[-1].published)
+            self.executor.defer(self.regenerate, batch_size, posts[-1].published)
 
 class PageRegenerator(object):
-    def __init__(self):
+    def __init__(self, executor=None):
         self.seen = set()
+        self.executor = executor or executors.TaskQueueExecutor()
 
     def regenerate(self, batch_size=50, start_ts=None):
         """
@@ -57,26 +76,56 @@ class PageRegenerator(object):
         q.filter('created <', start_ts or datetime.datetime.max)
         pages = q.fetch(batch_size)
         for page in pages:
-            deferred.defer(generators.PageContentGenerator.generate_resource, page, None);
+            self.executor.submit(generators.PageContentGenerator, page, None)
             page.put()
         if len(pages) == batch_size:
-            deferred.defer(self.regenerate, batch_size, pages[-1].created)
+            self.executor.defer(self.regenerate, batch_size, pages[-1].created)
 
-class TagCloudRegenerator(object):
+class SitemapRegenerator(object):
     def regenerate(self):
-        import logging
-        logging.debug("TagCloudRegenerator is resetting count for all tags.")
-        from google.appengine.ext import db
-        # Reset every tag counter.
-        db.delete(models.TagCounter.all())
+        """
+        Splits the sitemap into shards afresh, by path, and regenerates every
+        shard. Run to merge shards after config.sitemap_shard_size is
+        raised, or to shard a sitemap stored before shards were by path.
+        """
+        utils.reshard_sitemap()
+
+class TagCloudRegenerator(object):
+    def __init__(self, next_regenerator=None):
+        """next_regenerator, if given, is regenerated once every tag has
+        been counted, so it doesn't count posts while they are recounted."""
+        self.next_regenerator = next_regenerator
+
+    def regenerate(self, batch_size=100, cursor=None):
+        """Counts the tags of every post from scratch, batch_size at a time."""
+        if not cursor:
+            logging.debug("TagCloudRegenerator is resetting count for all tags.")
+            models.reset_tag_counts()
+        q = models.BlogPost.all().filter('is_published =', True)
+        if cursor:
+            q.with_cursor(cursor)
+        posts = q.fetch(batch_size)
+        deltas = {}
+        for post in posts:
+            for tag in post.normalized_tags:
+                deltas[tag] = deltas.get(tag, 0) + 1
+            post.counted_tags = list(post.normalized_tags)
+        db.put(posts)
+        models.update_tag_counts(deltas)
+        if len(posts) == batch_size:
+            deferred.defer(self.regenerate, batch_size, q.cursor())
+        else:
+            generators.TagCloudContentGenerator.generate_resource(None, None)
+            if self.next_regenerator:
+                deferred.defer(self.next_regenerator.regenerate)
 
 post_deploy_tasks = []
 
 def generate_static_pages(pages):
     def generate(previous_version):
-        for path, template, indexed in pages:
-            rendered = utils.render_template(template)
-            static.set(path, rendered, config.html_mime_type, indexed)
+        static.set_multi([
+            (path, utils.render_template(template), config.html_mime_type, indexed)
+            for path, template, indexed in pages])
     return generate
 
 post_deploy_tasks.append(generate_static_pages([
@@ -86,6 +135,65 @@ post_deploy_tasks.append(generate_static_pages([
 ]))
 
 
+def render_not_found(previous_version):
+    """Renders the 404 page once, with slots for the per-user parts."""
+    body, slots = utils.compose_page('', '404.html')
+    static.set(static.NOT_FOUND_PATH, body, config.html_mime_type, False,
+               composed=True, slots=slots, status=404)
+
+post_deploy_tasks.append(render_not_found)
+
+
+def render_fragments(previous_version):
+    for generator_class in generators.fragment_list:
+        if generator_class.generate_on_deploy:
+            generator_class.generate_resource(None, None)
+
+post_deploy_tasks.append(render_fragments)
+
+
+def shard_tag_counters(previous_version):
+    """Drops the unsharded TagCounters, which counted every publish of a post.
+
+    The PostRegenerator started by regenerate_all counts each post again.
+    """
+    if (
+        previous_version.bloggart_major,
+        previous_version.bloggart_minor,
+        previous_version.bloggart_rev,
+    ) < (1, 0, 4):
+        models.reset_tag_counts()
+
+post_deploy_tasks.append(shard_tag_counters)
+
+
+def count_archive(previous_version):
+    """Drops the Archive, so the PostRegenerator counts every post into it."""
+    if (
+        previous_version.bloggart_major,
+        previous_version.bloggart_minor,
+        previous_version.bloggart_rev,
+    ) < (1, 0, 5):
+        db.delete(models.Archive.all(keys_only=True))
+
+post_deploy_tasks.append(count_archive)
+
+
+def split_timeline(previous_version):
+    """Drops the Timeline of all posts, now kept as one Timeline per year.
+
+    The PostRegenerator started by regenerate_all records each post's year.
+    """
+    if (
+        previous_version.bloggart_major,
+        previous_version.bloggart_minor,
+        previous_version.bloggart_rev,
+    ) < (1, 0, 8):
+        db.delete(db.Key.from_path('Timeline', 'posts'))
+
+post_deploy_tasks.append(split_timeline)
+
+
 def regenerate_all(previous_version):
     if (
         previous_version.bloggart_major,
@@ -98,6 +206,17 @@ def regenerate_all(previous_version):
 post_deploy_tasks.append(regenerate_all)
 
 
+def shard_sitemap(previous_version):
+    if (
+        previous_version.bloggart_major,
+        previous_version.bloggart_minor,
+        previous_version.bloggart_rev,
+    ) < (1, 0, 7):
+        deferred.defer(SitemapRegenerator().regenerate)
+
+post_deploy_tasks.append(shard_sitemap)
+
+
 def site_verification(previous_version):
     static.set('/' + config.google_site_verification,
                          utils.render_template('site_verification.html'),
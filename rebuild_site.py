@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Regenerates every post, page and sidebar fragment of a site locally.
+
+This does what the admin Regenerate button does, but rather than queueing a
+task per resource, it renders resources on a pool of worker processes (or
+threads), and stores what they render from a single writer. It's meant for
+self-hosted sites and offline rebuilds, such as of a dev_appserver.py
+datastore before exporting it with export_static.py.
+
+Usage:
+  rebuild_site.py --datastore_path=FILE
+  rebuild_site.py --host=HOST
+"""
+
+import logging
+import optparse
+import sys
+import time
+
+import fix_path
+import config
+
+
+def rebuild(executor):
+    """Regenerates the whole site with executor.
+
+    Returns:
+      A list of the jobs that failed.
+    """
+    import generators
+    import post_deploy
+    # Posts are counted and their jobs queued first; local executors only
+    # run jobs once join() is called, so every job sees all the counts.
+    jobs = generators.collect_jobs(
+        post_deploy.PostRegenerator(executor).regenerate)
+    post_deploy.PageRegenerator(executor).regenerate()
+    for generator_class, args in jobs:
+        executor.submit(generator_class, *args)
+    for generator_class in generators.fragment_list:
+        executor.submit(generator_class, None, None)
+    failed = executor.join()
+    # Sitemap updates are queued as tasks, which don't run here. Shards split
+    # while they are regenerated are regenerated along with them.
+    import static
+    import utils
+    for start, shard in static.get_sitemap_shards():
+        utils._regenerate_sitemap_shard(shard)
+    utils._regenerate_sitemap()
+    return failed
+
+
+def main(argv):
+    try:
+        import multiprocessing
+        default_workers = multiprocessing.cpu_count()
+        default_executor = 'processes'
+    except (ImportError, NotImplementedError):
+        default_workers = config.generator_workers
+        default_executor = 'threads'
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Regenerates every post, page and sidebar fragment.')
+    parser.add_option('--app_id', default='jugglethis-wikiblog',
+                      help='The application id, as in app.yaml.')
+    parser.add_option('--datastore_path',
+                      help='Use this dev_appserver datastore file.')
+    parser.add_option('--host',
+                      help='Use the app at this host, via /remote_api.')
+    parser.add_option('--executor', default=default_executor,
+                      choices=['processes', 'threads'],
+                      help='Render on processes or threads (default %default).')
+    parser.add_option('--workers', type='int', default=default_workers,
+                      help='How many to render at once (default %default).')
+    options, args = parser.parse_args(argv[1:])
+    if args or bool(options.datastore_path) == bool(options.host):
+        parser.error('Give one of --datastore_path or --host.')
+
+    fix_path.fix_sys_path()
+    # Nothing offline should be announced to hubs or search engines.
+    config.hubbub_hub_url = None
+    config.google_sitemap_ping = False
+    import export_static
+    export_static.setup_stubs(options.app_id, options.datastore_path,
+                              options.host)
+    import executors
+    logging.getLogger().setLevel(logging.INFO)
+    start = time.time()
+    failed = rebuild(executors.get_executor(options.executor, options.workers))
+    print 'Rebuilt in %.1fs with %d %s, %d jobs failed.' % (
+        time.time() - start, options.workers, options.executor, len(failed))
+    return bool(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
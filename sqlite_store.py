@@ -0,0 +1,190 @@
+"""A static content backend that keeps everything in two local files.
+
+Bodies are appended to a data file, which is memory-mapped for reading, and
+a SQLite table maps each path to its StaticContent (without the bodies) and
+to where its bodies are in the data file. Nothing needs the datastore or
+memcache, so the read path can be self-hosted, and benchmarks and tests can
+run without API stubs. Creating StaticContent entities still needs
+APPLICATION_ID to be set in the environment, and storing indexed content
+queues sitemap tasks, as the datastore backend does.
+
+The data file is only ever appended to; space left behind by replaced or
+deleted content is not reclaimed.
+"""
+
+import mmap
+import sqlite3
+import threading
+
+from google.appengine.ext import db
+from google.appengine.datastore import entity_pb
+
+import static
+
+
+class SQLiteBackend(object):
+  """Keeps static content in a SQLite path table and a memory-mapped file.
+
+  Has the same methods as static.DatastoreBackend.
+  """
+  def __init__(self, filename):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.text_factory = str
+    self.db.execute(
+        'CREATE TABLE IF NOT EXISTS content ('
+        ' path TEXT PRIMARY KEY,'
+        ' entity BLOB NOT NULL,'
+        ' body_offset INTEGER, body_length INTEGER,'
+        ' gz_offset INTEGER, gz_length INTEGER,'
+        ' indexed INTEGER, last_modified TIMESTAMP)')
+    self.db.commit()
+    self.data = open(filename + '.data', 'a+b')
+    self.map = None
+
+  def _append(self, data):
+    """Appends data to the data file, and returns (offset, length)."""
+    if data is None:
+      return None, None
+    self.data.seek(0, 2)
+    offset = self.data.tell()
+    self.data.write(data)
+    return offset, len(data)
+
+  def _read(self, offset, length):
+    if offset is None:
+      return None
+    if not length:
+      return ''
+    if not self.map or offset + length > len(self.map):
+      # The file has grown since it was mapped.
+      self.data.flush()
+      if self.map:
+        self.map.close()
+      self.map = mmap.mmap(self.data.fileno(), 0, access=mmap.ACCESS_READ)
+    # This copies the body out of the map, as the rest of static expects a
+    # str, and a buffer wouldn't survive the map being replaced.
+    return self.map[offset:offset + length]
+
+  def _row(self, built):
+    """Appends the bodies of built content, and returns its table row."""
+    content, chunks = built
+    body, body_gz = content.body, content.body_gz
+    if content.chunks:
+      # There's no size limit here, so chunks are joined back together.
+      series = {'body': [], 'gz': []}
+      for chunk in chunks:
+        etag, name, i = chunk.key().name().split('/')
+        series[name].append((int(i), chunk.body))
+      body = ''.join(x[1] for x in sorted(series['body']))
+      body_gz = ''.join(x[1] for x in sorted(series['gz'])) or body_gz
+      content.chunks = content.gz_chunks = 0
+    content.body = content.body_gz = None
+    try:
+      entity = db.model_to_protobuf(content).Encode()
+    finally:
+      content.body, content.body_gz = body, body_gz
+    body_offset, body_length = self._append(body)
+    gz_offset, gz_length = self._append(body_gz)
+    return (content.key().name(), buffer(entity),
+            body_offset, body_length, gz_offset, gz_length,
+            int(content.indexed), content.last_modified)
+
+  def get(self, path):
+    self.lock.acquire()
+    try:
+      row = self.db.execute(
+          'SELECT entity, body_offset, body_length, gz_offset, gz_length'
+          ' FROM content WHERE path = ?', (path,)).fetchone()
+      if not row:
+        return None
+      content = db.model_from_protobuf(entity_pb.EntityProto(str(row[0])))
+      content.body = self._read(row[1], row[2])
+      content.body_gz = self._read(row[3], row[4])
+      return content
+    finally:
+      self.lock.release()
+
+  def get_multi(self, paths):
+    return [self.get(path) for path in paths]
+
+  def iter_chunks(self, content, series):
+    # Content is never stored in chunks.
+    return iter([])
+
+  def put(self, built):
+    self.lock.acquire()
+    try:
+      rows = [self._row(x) for x in built]
+      self.data.flush()
+      self.db.executemany(
+          'INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+          rows)
+      self.db.commit()
+    finally:
+      self.lock.release()
+    static._schedule_sitemap(
+        [x.key().name() for x, chunks in built if x.indexed])
+
+  def add(self, built):
+    self.lock.acquire()
+    try:
+      row = self._row(built)
+      self.data.flush()
+      cursor = self.db.execute(
+          'INSERT OR IGNORE INTO content VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+      self.db.commit()
+      added = cursor.rowcount == 1
+    finally:
+      self.lock.release()
+    if added and built[0].indexed:
+      static._schedule_sitemap([built[0].key().name()])
+    return added
+
+  def delete(self, paths):
+    removed = [x for x in (self.get(path) for path in paths) if x]
+    self.lock.acquire()
+    try:
+      self.db.executemany('DELETE FROM content WHERE path = ?',
+                          [(x,) for x in paths])
+      self.db.commit()
+    finally:
+      self.lock.release()
+    static._schedule_sitemap([x.key().name() for x in removed if x.indexed])
+    return removed
+
+  def paths_between(self, start, end):
+    self.lock.acquire()
+    try:
+      return [x[0] for x in self.db.execute(
+          'SELECT path FROM content WHERE path >= ? AND path < ?'
+          ' ORDER BY path', (start, end))]
+    finally:
+      self.lock.release()
+
+  def sitemap_paths(self, start, end=None):
+    self.lock.acquire()
+    try:
+      if end:
+        rows = self.db.execute(
+            'SELECT path FROM content WHERE indexed AND path >= ? AND path < ?'
+            ' ORDER BY path', (start, end))
+      else:
+        rows = self.db.execute(
+            'SELECT path FROM content WHERE indexed AND path >= ?'
+            ' ORDER BY path', (start,))
+      return [x[0] for x in rows]
+    finally:
+      self.lock.release()
+
+  def modified_paths(self, since=None):
+    self.lock.acquire()
+    try:
+      if since:
+        rows = self.db.execute(
+            'SELECT path FROM content WHERE last_modified >= ?', (since,))
+      else:
+        rows = self.db.execute('SELECT path FROM content')
+      return [x[0] for x in rows]
+    finally:
+      self.lock.release()
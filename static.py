@@ -1,8 +1,18 @@
+import bisect
 import datetime
 import hashlib
+import itertools
+import math
+import random
+import re
+import threading
+import time
+import urllib
+import zlib
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.datastore import entity_pb
@@ -13,10 +23,7 @@ from google.appengine.api import users
 
 import fix_path
 
-# If your app fails to import aetycoon during development testing, you have
-# most likely forgotten to init and update git submodules.
-import aetycoon
-
+import batching
 import config
 import utils
 import models
@@ -31,6 +38,34 @@ if config.google_site_verification:
 else:
     ROOT_ONLY_FILES = ['/robots.txt']
 
+# Content under these paths is served as stored, rather than via base.html.
+STRAIGHT_THROUGH_PATHS = ('/sitemap.xml', '/sitemap-', '/feeds/', '/search', '/cse')
+
+# Sidebar fragments, in the order they appear on the page. Each is stored
+# under its name by a FragmentContentGenerator, and they are joined into the
+# sidebar slot of every page as it is served.
+SIDEBAR_FRAGMENTS = ('tagcloud', 'authorcloud', 'sidebars')
+
+# Surrogate key of every page the sidebar appears on.
+SIDEBAR_KEY = 'sidebar'
+
+# Where the list of sitemap shards is stored; it's not served, as it has no
+# leading '/'.
+SITEMAP_SHARDS_PATH = 'sitemap-shards'
+
+# The pre-rendered page that is served for paths with no content.
+NOT_FOUND_PATH = '404'
+
+# Content types that are stored with a gzipped variant.
+COMPRESSIBLE_TYPES = ('text/', 'application/xml', 'application/atom+xml')
+
+# Most surrogate keys sent in one purge request.
+PURGE_BATCH_SIZE = 256
+
+# Content bigger than this is split into StaticContentChunk entities, so that
+# every entity and memcache value stays under the 1MB limit.
+CHUNK_SIZE = 900 * 1000
+
 class StaticContent(db.Model):
     """Container for statically served content.
     
@@ -40,92 +75,1020 @@ class StaticContent(db.Model):
     content_type = db.StringProperty()
     status = db.IntegerProperty(required=True, default=200)
     last_modified = db.DateTimeProperty(required=True)
-    etag = aetycoon.DerivedProperty(lambda x: hashlib.sha1(x.body).hexdigest())
+    etag = db.StringProperty()
     indexed = db.BooleanProperty(required=True, default=True)
     headers = db.StringListProperty()
+    # Tags for purging this content from downstream caches, sent in the
+    # Surrogate-Key header. The first is the most specific.
+    surrogate_keys = db.StringListProperty()
+    # True if body is a complete page rendered through base.html, with the
+    # per-request parts cut out at the offsets listed in slots.
+    composed = db.BooleanProperty(default=False)
+    slots = db.StringListProperty()
+    # Set by generators to a hash of what the content was rendered from, so
+    # that unchanged content need not be rendered again.
+    source_hash = db.StringProperty(indexed=False)
+    # The body compressed by utils.deflate_page, for compressible content.
+    body_gz = db.BlobProperty()
+    gz_slots = db.StringListProperty()
+    # Length and CRC-32 of the whole body. The CRC is only stored for content
+    # without slots, and saves computing the gzip trailer per request.
+    size = db.IntegerProperty()
+    body_crc = db.IntegerProperty()
+    # Number of StaticContentChunk entities holding body and body_gz, for
+    # content too large to store inline.
+    chunks = db.IntegerProperty(default=0)
+    gz_chunks = db.IntegerProperty(default=0)
+
+    @property
+    def has_gzip(self):
+        return bool(self.body_gz or self.gz_chunks)
+
+
+class StaleContentError(Exception):
+    """Raised when a chunk of content being read is missing, or belongs to
+    content that has since replaced it."""
+
+
+class StaticContentChunk(db.Model):
+    """A piece of a StaticContent too large for one entity.
+
+    Chunks are children of their StaticContent, with key names like
+    'ETAG/body/N' or 'ETAG/gz/N', so that storing new content doesn't
+    overwrite the chunks of the content it replaces while that may still be
+    read. They also carry the etag of the content they were written for.
+    """
+    body = db.BlobProperty()
+    etag = db.StringProperty()
+
+
+def uses_base_template(path):
+    """Returns True if content stored at path is served inside base.html."""
+    return path.startswith('/') and not path.startswith(STRAIGHT_THROUGH_PATHS)
+
+
+def get_sitemap_shards():
+    """Returns the sitemap shards, as a sorted list of (start, shard) pairs.
+
+    Each shard lists the indexed paths from its start up to the start of the
+    next one, so a path stays in its shard until that shard is split. The
+    first shard starts at ''.
+    """
+    content = get(SITEMAP_SHARDS_PATH)
+    if not content or not content.body:
+        return [('', 0)]
+    shards = []
+    for line in content.body.decode('utf-8').split('\n'):
+        shard, start = line.split('\t', 1)
+        shards.append((start, int(shard)))
+    return shards
+
+
+def set_sitemap_shards(shards):
+    """Stores the sitemap shards, given (start, shard) pairs."""
+    body = '\n'.join('%d\t%s' % (shard, start)
+                     for start, shard in sorted(shards))
+    set(SITEMAP_SHARDS_PATH, body.encode('utf-8'), 'text/plain', False)
+
+
+def sitemap_shard(path, shards):
+    """Returns the number of the sitemap shard that lists path."""
+    i = bisect.bisect_right([x[0] for x in shards], path) - 1
+    return shards[max(i, 0)][1]
+
+
+def sitemap_shard_range(shard, shards):
+    """Returns the (start, end) of the paths a shard lists, where end is None
+    for the last shard, or None if there is no such shard."""
+    for i, (start, number) in enumerate(shards):
+        if number == shard:
+            if i + 1 < len(shards):
+                return start, shards[i + 1][0]
+            return start, None
+    return None
+
+
+def surrogate_key(*parts):
+    """Returns a surrogate key made of parts, such as ('post', 42)."""
+    key = []
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        key.append(urllib.quote(str(part), safe=''))
+    return ':'.join(key)
+
+
+def is_compressible(content_type):
+    """Returns True if content of this MIME type is worth gzipping."""
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class _LRUCache(object):
+  """A least recently used cache whose capacity is measured in bytes.
+
+  Entries are kept in a circular doubly linked list of
+  [prev, next, key, value, size] links, most recently used last. Every
+  method takes a lock, as even get() relinks the list, and the local
+  executors read and write static content from several threads.
+  """
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.size = 0
+    self.links = {}
+    self.root = []
+    self.root[:] = [self.root, self.root, None, None, 0]
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    self.lock.acquire()
+    try:
+      link = self.links.get(key)
+      if link is None:
+        return None
+      self._unlink(link)
+      self._append(link)
+      return link[3]
+    finally:
+      self.lock.release()
+
+  def put(self, key, value, size):
+    self.lock.acquire()
+    try:
+      self._remove(key)
+      if size > self.max_size:
+        return
+      link = [None, None, key, value, size]
+      self.links[key] = link
+      self._append(link)
+      self.size += size
+      while self.size > self.max_size:
+        self._remove(self.root[1][2])
+    finally:
+      self.lock.release()
+
+  def remove(self, key):
+    self.lock.acquire()
+    try:
+      self._remove(key)
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.size = 0
+      self.links = {}
+      self.root[:] = [self.root, self.root, None, None, 0]
+    finally:
+      self.lock.release()
+
+  def _remove(self, key):
+    link = self.links.pop(key, None)
+    if link is not None:
+      self._unlink(link)
+      self.size -= link[4]
+
+  def _unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def _append(self, link):
+    last = self.root[0]
+    link[0] = last
+    link[1] = self.root
+    last[1] = self.root[0] = link
+
+
+# Decoded StaticContent entities, as (entity, generation) tuples.
+_cache = _LRUCache(config.static_cache_size)
+
+# Memcache counter that set() and remove() bump whenever the store changes.
+# Instances only trust their local cache while it matches.
+GENERATION_KEY = 'static:generation'
+_generation = None
+_generation_checked = 0
+
+
+def _get_generation():
+  """Returns the store generation, checking memcache at most once every
+  config.static_cache_check_interval seconds."""
+  global _generation, _generation_checked
+  now = time.time()
+  if _generation is None or now - _generation_checked >= config.static_cache_check_interval:
+    _generation = memcache.get(GENERATION_KEY)
+    _generation_checked = now
+    if _generation is None:
+      _bump_generation()
+  return _generation
+
+
+def _bump_generation():
+  """Invalidates the local caches of every instance."""
+  global _generation, _generation_checked
+  # Start from the current time in ms, so a counter evicted from memcache
+  # never restarts at a value an instance has already cached against.
+  _generation = memcache.incr(GENERATION_KEY,
+                              initial_value=int(time.time() * 1000))
+  _generation_checked = time.time()
+  return _generation
+
+
+def _cache_put(path, entity, generation):
+  if generation is not None:
+    size = len(path) + 256
+    if entity:
+      size += (len(entity.body or '') + len(entity.body_gz or '') +
+               sum(len(x) for x in entity.headers))
+    _cache.put(path, (entity, generation), size)
+
+
+# Stored in memcache for paths that have no content.
+_MISSING = ''
+
+# Memcache key prefixes for the time a path's cached content expires, and
+# for the lease taken by the one request that reloads it.
+_EXPIRY_PREFIX = 'static:expires:'
+_LEASE_PREFIX = 'static:lease:'
+
+# Assumed time to load content from the datastore, when it wasn't measured.
+_DEFAULT_LOAD_TIME = 0.05
+
+
+def _expiry_value(ttl, load_time):
+  return '%f %f' % (time.time() + ttl, load_time)
+
+
+def _refresh_early(expiry):
+  """Decides at random whether to reload content before it expires.
+
+  The closer the content is to expiring, and the longer it took to load,
+  the likelier a reload is, so hot paths are refreshed by one request
+  ahead of time rather than by every request once they expire.
+  """
+  if not expiry:
+    return False
+  try:
+    expires, load_time = [float(x) for x in expiry.split()]
+  except ValueError:
+    return False
+  early = -load_time * config.static_refresh_beta * math.log(1.0 - random.random())
+  return time.time() + early >= expires
+
+
+def _wait_for(path):
+  """Waits for another request's lease on path, and returns what it stored."""
+  deadline = time.time() + config.static_lease_time
+  while time.time() < deadline:
+    time.sleep(0.05)
+    value = memcache.get(path)
+    if value is not None:
+      return value
+  return None
+
+
+def _load(path):
+  """Reads the content for path from the datastore into memcache.
+
+  Also releases the lease on path, if this request holds it.
+  """
+  start = time.time()
+  entity = StaticContent.get_by_key_name(path)
+  load_time = time.time() - start
+  if entity:
+    ttl = config.static_memcache_ttl
+    memcache.set_multi({
+        path: db.model_to_protobuf(entity).Encode(),
+        _EXPIRY_PREFIX + path: _expiry_value(ttl, load_time),
+    }, time=ttl)
+  else:
+    # Storing content replaces this, as it's under the same key.
+    ttl = config.static_negative_cache_ttl
+    memcache.add_multi({
+        path: _MISSING,
+        _EXPIRY_PREFIX + path: _expiry_value(ttl, load_time),
+    }, time=ttl)
+  memcache.delete(_LEASE_PREFIX + path)
+  return entity
 
 
 def get(path):
     """Returns the StaticContent object for the provided path.
-    
+
     Args:
       path: The path to retrieve StaticContent for.
     Returns:
       A StaticContent object, or None if no content exists for this path.
     """
-    entity = memcache.get(path)
-    if entity:
-        entity = db.model_from_protobuf(entity_pb.EntityProto(entity))
+    batch = batching.current()
+    if batch is not None:
+        pending, content = batch.get(path)
+        if pending:
+            return content
+    return backend().get(path)
+
+
+def _datastore_get(path):
+    """Returns the StaticContent for path from the datastore backend.
+
+    Content is looked up in the instance's own cache, then memcache, then
+    the datastore. Paths with no content are remembered for a short while
+    too, so repeated requests for them don't reach the datastore.
+
+    Only one request at a time reloads a path from the datastore. Others
+    are served the copy this instance had before, or wait for the reload.
+    """
+    generation = _get_generation()
+    cached = _cache.get(path)
+    if cached and cached[1] == generation:
+        return cached[0]
+    values = memcache.get_multi([path, _EXPIRY_PREFIX + path])
+    value = values.get(path)
+    leased = False
+    if value is None or _refresh_early(values.get(_EXPIRY_PREFIX + path)):
+        leased = memcache.add(_LEASE_PREFIX + path, 1,
+                              time=config.static_lease_time)
+        if value is None and not leased:
+            # Another request is already loading this path.
+            if cached:
+                return cached[0]
+            value = _wait_for(path)
+    if leased or value is None:
+        entity = _load(path)
+    elif value == _MISSING:
+        entity = None
     else:
-        entity = StaticContent.get_by_key_name(path)
-    if entity:
-        memcache.set(path, db.model_to_protobuf(entity).Encode())
+        entity = db.model_from_protobuf(entity_pb.EntityProto(value))
+    _cache_put(path, entity, generation)
     return entity
 
 
-def set(path, body, content_type, indexed=True, **kwargs):
-  """Sets the StaticContent for the provided path.
+def _split_chunks(content):
+  """Moves the body of oversized content into StaticContentChunk entities.
+
+  Returns:
+    The list of chunk entities to store alongside content, which is empty if
+    the content fits in one entity.
+  """
+  if len(content.body) + len(content.body_gz or '') <= CHUNK_SIZE:
+    return []
+  if content.slots:
+    # The gzip trailer for a page with slots is computed from the whole
+    # spliced page, which would mean reading every chunk twice. Serve
+    # these rare pages uncompressed instead.
+    content.body_gz = None
+    content.gz_slots = []
+  chunks = []
+  counts = {}
+  for series, data in (('body', content.body), ('gz', content.body_gz or '')):
+    offsets = range(0, len(data), CHUNK_SIZE)
+    for i, offset in enumerate(offsets):
+      chunks.append(StaticContentChunk(
+          parent=content.key(),
+          key_name=_chunk_key_name(content.etag, series, i),
+          body=data[offset:offset + CHUNK_SIZE],
+          etag=content.etag))
+    counts[series] = len(offsets)
+  content.chunks = counts['body']
+  content.gz_chunks = counts['gz']
+  content.body = ''
+  content.body_gz = None
+  return chunks
+
+
+def _chunk_key_name(etag, series, i):
+  return '%s/%s/%d' % (etag, series, i)
+
+
+def _chunk_cache_key(content, name):
+  return '%s#%s#%s' % (content.key().name(), content.etag, name)
+
+
+def iter_chunks(content, series='body'):
+  """Returns an iterator over the body (or gzipped body) of chunked content.
 
   Args:
-    path: The path to store the content against.
-    body: The data to serve for that path.
-    content_type: The MIME type to serve the content as.
-    indexed: Index this page in the sitemap?
-    **kwargs: Additional arguments to be passed to the StaticContent constructor
+    content: A StaticContent with chunks.
+    series: 'body' or 'gz'.
+  """
+  return backend().iter_chunks(content, series)
+
+
+def _datastore_iter_chunks(content, series):
+  """Yields chunks from memcache or the datastore one at a time, so large
+  content is served without holding all of it in memory.
+  """
+  if series == 'body':
+    count = content.chunks
+  else:
+    count = content.gz_chunks
+  for i in range(count):
+    name = _chunk_key_name(content.etag, series, i)
+    cache_key = _chunk_cache_key(content, name)
+    data = memcache.get(cache_key)
+    if data is None:
+      chunk = StaticContentChunk.get_by_key_name(name, parent=content)
+      if not chunk or chunk.etag != content.etag:
+        # The content was replaced while we were reading it.
+        raise StaleContentError('Chunk %s of %s is missing or stale'
+                                % (name, content.key().name()))
+      data = chunk.body
+      memcache.set(cache_key, data)
+    yield data
+
+
+def _build(path, body, content_type, indexed=True, **kwargs):
+  """Creates, but does not store, the StaticContent for a path.
+
   Returns:
-    A StaticContent object.
+    A (content, chunks) tuple, as returned by _split_chunks.
   """
   now = datetime.datetime.now().replace(second=0, microsecond=0)
   defaults = {
     'last_modified': now,
   }
+  # Content is tagged with its own path unless the caller knows better.
+  keys = list(kwargs.pop('surrogate_keys', None) or [surrogate_key(path)])
+  if uses_base_template(path):
+    keys.append(SIDEBAR_KEY)
+  defaults['surrogate_keys'] = keys
+  if uses_base_template(path):
+    # Render the anonymous page now, so serving it needs no template work.
+    body, defaults['slots'] = utils.compose_page(body)
+    defaults['composed'] = True
+  slots = kwargs.get('slots', defaults.get('slots', []))
+  if is_compressible(content_type):
+    defaults['body_gz'], defaults['gz_slots'] = utils.deflate_page(body, slots)
+  if not slots:
+    defaults['body_crc'] = zlib.crc32(body) & 0xffffffff
   defaults.update(kwargs)
   content = StaticContent(
       key_name=path,
       body=body,
       content_type=content_type,
       indexed=indexed,
+      etag=hashlib.sha1(body).hexdigest(),
+      size=len(body),
       **defaults)
-  content.put()
-  memcache.replace(path, db.model_to_protobuf(content).Encode())
-  try:
-    eta = now.replace(second=0, microsecond=0) + datetime.timedelta(seconds=65)
-    if indexed:
+  return content, _split_chunks(content)
+
+
+def _chunk_keys(content):
+  """Returns the keys of the chunks of content, if it has any."""
+  keys = []
+  for series, count in (('body', content.chunks), ('gz', content.gz_chunks)):
+    for i in range(count or 0):
+      keys.append(db.Key.from_path(
+          'StaticContentChunk', _chunk_key_name(content.etag, series, i),
+          parent=content.key()))
+  return keys
+
+
+def _stale_chunk_keys(built):
+  """Returns the keys of the chunks of the content that built content
+  replaces, which built content doesn't use.
+
+  The content being replaced is only read if it or the new content is
+  chunked, going by this instance's cache; unchunked pages are the common
+  case, and chunks this misses are still deleted along with their page.
+  """
+  paths = []
+  for content, chunks in built:
+    cached = _cache.get(content.key().name())
+    if chunks or (cached and cached[0] and cached[0].chunks):
+      paths.append(content.key().name())
+  if not paths:
+    return []
+  new_keys = {}
+  for content, chunks in built:
+    for chunk in chunks:
+      new_keys[chunk.key()] = True
+  keys = []
+  for old in StaticContent.get_by_key_name(paths):
+    if old:
+      keys.extend(x for x in _chunk_keys(old) if x not in new_keys)
+  return keys
+
+
+def _put(built):
+  """Stores built content in the datastore, with as few calls as possible.
+
+  Each call is kept under CHUNK_SIZE bytes, so that a batch of large pages
+  doesn't exceed the datastore's request size limit. Chunks are stored
+  before the content that lists them, so content is never read without
+  its chunks.
+  """
+  group = []
+  group_size = 0
+  for content, chunks in built:
+    for entity in chunks + [content]:
+      size = len(entity.body or '') + len(getattr(entity, 'body_gz', None) or '')
+      if group and (group_size + size > CHUNK_SIZE or len(group) >= 500):
+        db.put(group)
+        group = []
+        group_size = 0
+      group.append(entity)
+      group_size += size
+  if group:
+    db.put(group)
+
+
+def _update_caches(built):
+  """Updates memcache and the local cache after content has been stored."""
+  ttl = config.static_memcache_ttl
+  paths = [content.key().name() for content, chunks in built]
+  not_replaced = memcache.replace_multi(dict(
+      (content.key().name(), db.model_to_protobuf(content).Encode())
+      for content, chunks in built), time=ttl)
+  memcache.set_multi(dict(
+      (_EXPIRY_PREFIX + path, _expiry_value(ttl, _DEFAULT_LOAD_TIME))
+      for path in paths if path not in not_replaced), time=ttl)
+  chunk_values = {}
+  for content, chunks in built:
+    for chunk in chunks:
+      chunk_values[_chunk_cache_key(content, chunk.key().name())] = chunk.body
+  if chunk_values:
+    memcache.set_multi(chunk_values)
+  generation = _bump_generation()
+  for content, chunks in built:
+    _cache_put(content.key().name(), content, generation)
+
+
+def _schedule_sitemap(paths):
+  """Schedules the sitemap shards listing paths to be regenerated.
+
+  Each shard is regenerated at most once a minute, at the end of the minute
+  it was first changed in.
+  """
+  now = datetime.datetime.now()
+  eta = now.replace(second=0, microsecond=0) + datetime.timedelta(seconds=65)
+  if not paths:
+    return
+  sitemap_shards = get_sitemap_shards()
+  shards = {}
+  for path in paths:
+    shards[sitemap_shard(path, sitemap_shards)] = True
+  for shard in shards:
+    try:
       deferred.defer(
-          utils._regenerate_sitemap,
-          _name='sitemap-%s' % (now.strftime('%Y%m%d%H%M'),),
+          utils._regenerate_sitemap_shard, shard,
+          _name='sitemap-%d-%s' % (shard, now.strftime('%Y%m%d%H%M')),
           _eta=eta)
-  except (taskqueue.taskqueue.TaskAlreadyExistsError, taskqueue.taskqueue.TombstonedTaskError):
-    pass # TODO: Comment about why these two errors are OK?
-  return content
+    except (taskqueue.taskqueue.TaskAlreadyExistsError, taskqueue.taskqueue.TombstonedTaskError):
+      pass # The shard is already due to be regenerated this minute.
+
+
+class Batch(object):
+  """Collects set() and remove() calls so they can be stored together.
+
+  A batch is committed with one datastore put and delete, one memcache
+  update, and at most one sitemap refresh, rather than one of each for
+  every path.
+  """
+  def __init__(self):
+    self.built = {}
+    self.removed = {}
+
+  def get(self, path):
+    """Returns (True, content) if the batch has a pending write for path."""
+    if path in self.removed:
+      return True, None
+    if path in self.built:
+      return True, self.built[path][0]
+    return False, None
+
+  def set(self, path, body, content_type, indexed=True, **kwargs):
+    self.removed.pop(path, None)
+    self.built[path] = _build(path, body, content_type, indexed, **kwargs)
+    return self.built[path][0]
+
+  def remove(self, path):
+    self.built.pop(path, None)
+    self.removed[path] = True
+
+  def commit(self):
+    keys = []
+    if self.built:
+      keys.extend(_store(self.built.values()))
+    if self.removed:
+      keys.extend(_remove(self.removed.keys()))
+    purge(keys)
+
+
+def set(path, body, content_type, indexed=True, **kwargs):
+  """Sets the StaticContent for the provided path.
+
+  Inside a function decorated with batched(), the content is only stored
+  when that function returns.
+
+  Args:
+    path: The path to store the content against.
+    body: The data to serve for that path.
+    content_type: The MIME type to serve the content as.
+    indexed: Index this page in the sitemap?
+    **kwargs: Additional arguments to be passed to the StaticContent constructor
+  Returns:
+    A StaticContent object.
+  """
+  batch = batching.current()
+  if batch is not None:
+    return batch.set(path, body, content_type, indexed, **kwargs)
+  built = _build(path, body, content_type, indexed, **kwargs)
+  purge(_store([built]))
+  return built[0]
+
+
+def set_multi(entries):
+  """Sets the StaticContent for several paths at once.
+
+  Args:
+    entries: A list of (path, body, content_type[, indexed[, kwargs]])
+      tuples, where kwargs is a dict of extra arguments as for set().
+  Returns:
+    A list of StaticContent objects.
+  """
+  built = []
+  for entry in entries:
+    kwargs = {}
+    if len(entry) > 4:
+      kwargs = entry[4]
+    built.append(_build(*entry[:4], **kwargs))
+  purge(_store(built))
+  return [content for content, chunks in built]
+
+
+def _store(built):
+  """Stores built content and updates the caches and sitemap to match.
+
+  Args:
+    built: A list of (content, chunks) tuples as returned by _build().
+  Returns:
+    The surrogate keys to purge from downstream caches.
+  """
+  backend().put(built)
+  return [x.surrogate_keys[0] for x, chunks in built]
+
 
 def add(path, body, content_type, indexed=True, **kwargs):
   """Adds a new StaticContent and returns it.
 
+  Unlike set(), this is never batched, since it has to check for existing
+  content in a transaction.
+
   Args:
     As per set().
   Returns:
     A StaticContent object, or None if one already exists at the given path.
   """
-  def _tx():
-    if StaticContent.get_by_key_name(path):
-      return None
-    return set(path, body, content_type, indexed, **kwargs)
-  return db.run_in_transaction(_tx) # Runs the _tx function in a single database transaction - if anything raises an exception, the whole transaction is rolled back.
+  built = _build(path, body, content_type, indexed, **kwargs)
+  if not backend().add(built):
+    return None
+  # Downstream caches may have kept a 404 for the path.
+  purge(built[0].surrogate_keys[:1])
+  return built[0]
+
+
+def _taken_suffixes(base):
+  """Returns the set of n for which base (n == 0) or base-n is in use.
+
+  This is a single keys-only scan over the range of keys starting with base.
+  """
+  pattern = re.compile('^%s(?:-(\\d+))?$' % re.escape(base))
+  taken = {}
+  # '.' sorts straight after '-', so this bounds every 'base-...' path.
+  for path in backend().paths_between(base, base + '.'):
+    match = pattern.match(path)
+    if match:
+      taken[int(match.group(1) or 0)] = True
+  return taken
+
+
+def add_unique(format_path, body, content_type, indexed=True, **kwargs):
+  """Adds a new StaticContent at the first free path given by format_path.
+
+  Args:
+    format_path: A function taking a number n and returning a candidate
+      path, such as utils.format_post_path. n == 0 must give the plain path,
+      and n > 0 the plain path with '-n' appended.
+    Others as per set().
+  Returns:
+    The StaticContent that was added.
+  """
+  base = format_path(0)
+  if format_path(1) != base + '-1':
+    # The number isn't at the end of the path, so free paths can't be
+    # found with a key range scan; try them one at a time.
+    num = 0
+    content = None
+    while not content:
+      content = add(format_path(num), body, content_type, indexed, **kwargs)
+      num += 1
+    return content
+  while True:
+    taken = _taken_suffixes(base)
+    num = 0
+    while num in taken:
+      num += 1
+    content = add(format_path(num), body, content_type, indexed, **kwargs)
+    if content:
+      return content
+    # Someone else claimed the path since the scan; look again.
+
 
 def remove(path):
   """Deletes a StaticContent.
 
+  Inside a function decorated with batched(), the content is only removed
+  when that function returns.
+
   Args:
     path: Path of the static content to be removed.
   """
-  memcache.delete(path)
-  def _tx():
-    content = StaticContent.get_by_key_name(path)
-    if not content:
-      return
-    content.delete()
-  return db.run_in_transaction(_tx)
+  batch = batching.current()
+  if batch is not None:
+    batch.remove(path)
+  else:
+    remove_multi([path])
+
+
+def remove_multi(paths):
+  """Deletes several StaticContents at once.
+
+  Args:
+    paths: A list of paths of the static content to be removed.
+  """
+  purge(_remove(paths))
+
+
+def _remove(paths):
+  """Deletes StaticContents, and returns the surrogate keys to purge."""
+  surrogate_keys = []
+  for content in backend().delete(paths):
+    surrogate_keys.extend(content.surrogate_keys[:1])
+  return surrogate_keys
+
+
+def _delete_content(path):
+  """Deletes the StaticContent at path and its chunks, and returns it.
+
+  Must be run in a transaction.
+  """
+  content = StaticContent.get_by_key_name(path)
+  if not content:
+    return None
+  keys = [content.key()]
+  if content.chunks or content.gz_chunks:
+    q = StaticContentChunk.all(keys_only=True).ancestor(content)
+    keys.extend(q.fetch(1000))
+  db.delete(keys)
+  return content
+
+
+class DatastoreBackend(object):
+  """Keeps static content in the datastore, cached in memcache and in each
+  instance. This is the backend used on App Engine.
+
+  A backend has the methods below. put() and add() take (content, chunks)
+  tuples as returned by _build().
+  """
+  def get(self, path):
+    """Returns the StaticContent for path, or None."""
+    return _datastore_get(path)
+
+  def get_multi(self, paths):
+    """Returns a list with the StaticContent (or None) for each path, read
+    in bulk, without going through the caches."""
+    return StaticContent.get_by_key_name(paths)
+
+  def iter_chunks(self, content, series):
+    """Returns an iterator over the chunks of content in a series."""
+    return _datastore_iter_chunks(content, series)
+
+  def put(self, built):
+    """Stores a list of built content, replacing any at the same paths."""
+    stale = _stale_chunk_keys(built)
+    _put(built)
+    _update_caches(built)
+    if stale:
+      # Only once nothing cached lists them any more.
+      db.delete(stale)
+    _schedule_sitemap([x.key().name() for x, chunks in built if x.indexed])
+
+  def add(self, built):
+    """Stores built content if its path is free. Returns True if it was."""
+    content = built[0]
+    def _tx():
+      if StaticContent.get_by_key_name(content.key().name()):
+        return False
+      _put([built])
+      return True
+    if not db.run_in_transaction(_tx): # Runs the _tx function in a single database transaction - if anything raises an exception, the whole transaction is rolled back.
+      return False
+    _update_caches([built])
+    if content.indexed:
+      _schedule_sitemap([content.key().name()])
+    return True
+
+  def delete(self, paths):
+    """Deletes the content at paths, and returns what was deleted."""
+    removed = []
+    for path in paths:
+      # Content and its chunks are one entity group, so each path is
+      # deleted in a transaction of its own.
+      content = db.run_in_transaction(_delete_content, path)
+      if content:
+        removed.append(content)
+    indexed = [x.key().name() for x in removed if x.indexed]
+    memcache.delete_multi(paths + [_EXPIRY_PREFIX + x for x in paths])
+    for path in paths:
+      _cache.remove(path)
+    _bump_generation()
+    _schedule_sitemap(indexed)
+    return removed
+
+  def paths_between(self, start, end):
+    """Returns the paths in use from start up to, but not including, end."""
+    q = StaticContent.all(keys_only=True)
+    q.filter('__key__ >=', db.Key.from_path('StaticContent', start))
+    q.filter('__key__ <', db.Key.from_path('StaticContent', end))
+    return _fetch_paths(q)
+
+  def sitemap_paths(self, start, end=None):
+    """Returns the paths of the indexed content from start up to, but not
+    including, end, or to the last path if end is None."""
+    q = StaticContent.all(keys_only=True).filter('indexed', True)
+    if start:
+      q.filter('__key__ >=', db.Key.from_path('StaticContent', start))
+    if end:
+      q.filter('__key__ <', db.Key.from_path('StaticContent', end))
+    return _fetch_paths(q)
+
+  def modified_paths(self, since=None):
+    """Returns the paths of the content last modified at or after since, or
+    of all content if since is None."""
+    q = StaticContent.all(keys_only=True)
+    if since:
+      q.filter('last_modified >=', since)
+    return _fetch_paths(q)
+
+
+def _fetch_paths(q):
+  """Returns the paths of every StaticContent key a keys-only query finds."""
+  paths = []
+  cur = q.fetch(1000)
+  while cur:
+    paths.extend(x.name() for x in cur)
+    if len(cur) < 1000:
+      break
+    q.with_cursor(q.cursor())
+    cur = q.fetch(1000)
+  return paths
+
+
+_backend = None
+
+
+def backend():
+  """Returns the backend that config.static_backend selects."""
+  global _backend
+  if _backend is None:
+    if config.static_backend == 'sqlite':
+      import sqlite_store
+      _backend = sqlite_store.SQLiteBackend(config.static_sqlite_path)
+    else:
+      _backend = DatastoreBackend()
+  return _backend
+
+
+def reset_backend():
+  """Drops this process' backend, and its cache of content, so they are
+  opened afresh; for processes forked from one that had them open."""
+  global _backend
+  _backend = None
+  _cache.clear()
+
+
+def purge(keys):
+  """Asks the downstream cache to drop everything tagged with keys.
+
+  Does nothing unless config.surrogate_purge_url is set. The purge is sent
+  from a task, so that it is retried if the cache can't be reached.
+  """
+  keys = sorted(dict.fromkeys(keys))
+  if keys and config.surrogate_purge_url:
+    deferred.defer(_send_purge, keys)
+
+
+def _send_purge(keys):
+  for i in range(0, len(keys), PURGE_BATCH_SIZE):
+    headers = dict(config.surrogate_purge_headers)
+    headers['Surrogate-Key'] = ' '.join(keys[i:i + PURGE_BATCH_SIZE])
+    response = urlfetch.fetch(config.surrogate_purge_url, '', urlfetch.POST,
+                              headers)
+    if response.status_code not in range(200, 300):
+      raise Exception('Purge failed', response.status_code, response.content)
+
+# The analytics snippet, rendered on first use.
+_analytics = None
+# The usernav of anonymous visitors, rendered on first use with a stand-in
+# for the login URL, which is all that differs between them.
+_anonymous_usernav = None
+_LOGIN_URL_STANDIN = 'bloggart-login-url'
+
+
+def _render_usernav(user_vals):
+  """Returns the usernav for user_vals, as get_user_vals returns them."""
+  global _anonymous_usernav
+  if user_vals['logged_in']:
+    return utils.render_template('usernav.html', user_vals)
+  if _anonymous_usernav is None:
+    template_vals = dict(user_vals, loginout_url=_LOGIN_URL_STANDIN)
+    _anonymous_usernav = utils.render_template('usernav.html', template_vals)
+  return _anonymous_usernav.replace(_LOGIN_URL_STANDIN,
+                                    user_vals['loginout_url'])
+
+
+def get_slot_fills(user_vals):
+  """Returns the strings to splice into the slots of a composed page.
+
+  Returns:
+    A (fills, version) tuple: a dict mapping slot names to strings, and a
+    string that changes whenever any of the fills do.
+  """
+  global _analytics
+  fragments = [x for x in (get(name) for name in SIDEBAR_FRAGMENTS) if x]
+  fills = {
+    'usernav': _render_usernav(user_vals),
+    'sidebar': ''.join(x.body for x in fragments),
+  }
+  if fragments and fragments[0].key().name() == 'tagcloud':
+    # Pages composed before sidebars were fragments have a slot for the
+    # tag cloud alone.
+    fills['tagcloud'] = fragments[0].body
+  if config.analytics_id and not utils.is_devel() and not user_vals['is_admin']:
+    if _analytics is None:
+      _analytics = utils.render_template('analytics.html')
+    fills['analytics'] = _analytics
+  user_hash = hashlib.sha1(fills['usernav'] + fills.get('analytics', ''))
+  version = '%s:%s' % (','.join(x.etag for x in fragments),
+                       user_hash.hexdigest())
+  return fills, version
+
+
+def get_pieces(content, fills, gzip):
+  """Returns an iterable of the strings that make up a response body.
+
+  Args:
+    content: The StaticContent to output.
+    fills: Slot fills as returned by get_slot_fills, or None if the
+      content is served straight through rather than in base.html.
+    gzip: True to return the stored gzipped variant of the content.
+  """
+  if content.chunks:
+    if gzip: # Only stored for content without slots.
+      return itertools.chain(
+          [utils.GZIP_HEADER], iter_chunks(content, 'gz'),
+          [utils.gzip_trailer(content.body_crc, content.size)])
+    return utils.splice_chunks(iter_chunks(content), content.slots,
+                               fills or {})
+  if fills is None: # Straight-through content
+    pieces = [content.body]
+  else:
+    body, slots = content.body, content.slots
+    if not content.composed:
+      # Content stored before pages were composed when generated.
+      body, slots = utils.compose_page(body)
+    # Fill in the parts of the page that depend on the current user.
+    pieces = utils.splice_slots(body, slots, fills)
+  if gzip:
+    if not content.slots and content.body_crc is not None:
+      return [utils.GZIP_HEADER, content.body_gz,
+              utils.gzip_trailer(content.body_crc, content.size)]
+    return utils.gzip_pieces(pieces, content.body_gz, content.gz_slots,
+                             fills or {})
+  return pieces
+
+
+def get_content_length(content, fills, gzip):
+  """Returns the length of the body get_pieces() would return, if known.
+
+  The length is worked out from the stored sizes, without building the
+  body. Returns None for gzipped pages with slots, since the fills are
+  only compressed as they are sent.
+  """
+  if content.size is None:
+    return None # Stored before sizes were recorded.
+  if gzip:
+    if content.slots or content.chunks or content.body_crc is None:
+      return None
+    return (len(utils.GZIP_HEADER) + len(content.body_gz) +
+            len(utils.gzip_trailer(0, 0)))
+  if fills is None:
+    return content.size
+  if not content.composed:
+    return None
+  return content.size + sum(len(fills.get(x.split(':', 1)[1], ''))
+                            for x in content.slots)
+
 
 class StaticContentHandler(webapp.RequestHandler):
   """ The webapp request handler.
@@ -136,106 +1099,242 @@ class StaticContentHandler(webapp.RequestHandler):
     only calls output_content() with serve==true if it's appropriate to serve
     the content. output_content() then actually writes the content.body out.
   """
-  def output_content(self, content, serve=True, uses_base_template=True):
+  def get_user_vals(self):
+    """Returns the template values that describe the current user.
+
+    Users who are logged in but have not set up a profile are redirected to
+    the profile page, and None is returned; the caller must then not write a
+    response of its own.
+    """
+    # Get the current user's name (or Anonymous), a link to logout
+    # (or in, if Anon), and the text to display this.
+    is_admin = False
+    logged_in = bool(users.get_current_user())
+    if logged_in:
+        identity = models.get_identity(users.get_current_user())
+        if identity['name'] is not None:
+            user_name = identity['name']
+        else: # If the user does not have a preferences object,
+              # redirect them to the user profile page.
+            self.redirect("/user")
+            return None
+
+        loginout_url = users.create_logout_url(self.request.uri)
+        url_linktext = 'Logout'
+        if users.is_current_user_admin():
+            is_admin = True
+    else:
+        user_name = 'Anonymous'
+        loginout_url = users.create_login_url(self.request.uri)
+        url_linktext = 'Login'
+    return {
+        'loginout_url': loginout_url,
+        'user_name': user_name,
+        'url_linktext': url_linktext,
+        'is_admin': is_admin,
+        'logged_in': logged_in}
+
+  def accepts_gzip(self):
+    """Returns True if the client accepts gzip content-coding."""
+    for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+      params = coding.split(';')
+      if params[0].strip().lower() in ('gzip', 'x-gzip'):
+        for param in params[1:]:
+          name, _, value = param.partition('=')
+          if name.strip() == 'q':
+            try:
+              return float(value) > 0
+            except ValueError:
+              return False
+        return True
+    return False
+
+  def output_content(self, content, serve=True, fills=None, etag=None,
+                     gzip=False):
+    """Writes the headers and, if serve is True, the body for content.
+
+    The body isn't written to self.response, but left in self.stream as an
+    iterable of strings for StreamingApplication to send.
+
+    Args:
+      content: The StaticContent to output.
+      serve: False to send a 304 Not Modified instead of the body.
+      fills: Slot fills as returned by get_slot_fills, or None if the
+        content is served straight through rather than in base.html.
+      etag: The ETag of this response; defaults to the content's.
+      gzip: True to send the stored gzipped variant of the content.
+    """
     if content.content_type:
         self.response.headers['Content-Type'] = content.content_type
     last_modified = content.last_modified.strftime(HTTP_DATE_FMT)
     self.response.headers['Last-Modified'] = last_modified
-    self.response.headers['ETag'] = '\"%s\"' % (content.etag,)
+    self.response.headers['ETag'] = '\"%s\"' % (etag or content.etag,)
+    vary = []
+    if content.has_gzip:
+        vary.append('Accept-Encoding')
+    if gzip:
+        self.response.headers['Content-Encoding'] = 'gzip'
+    if fills is None:
+        self.response.headers['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    else:
+        # The page differs between users, so shared caches must key it on
+        # the login cookie, and must not keep a logged in user's copy.
+        vary.append('Cookie')
+        if users.get_current_user():
+            self.response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+        else:
+            self.response.headers['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    if vary:
+        self.response.headers['Vary'] = ', '.join(vary)
+    if content.surrogate_keys:
+        self.response.headers['Surrogate-Key'] = ' '.join(content.surrogate_keys)
     for header in content.headers:
         key, value = header.split(':', 1)
         self.response.headers[key] = value.strip()
     if serve:
         self.response.set_status(content.status)
-        if uses_base_template:
-            # Grab the tagcloud content from the static store and add to 
-            # the template_vals so base.html can use it.
-            tagcloud = get('tagcloud').body
-            
-            # Get the current user's name (or Anonymous), a link to logout
-            # (or in, if Anon), and the text to display this.
-            is_admin = False
-            if users.get_current_user():
-                import models
-                q = db.GqlQuery('SELECT * FROM UserPrefs WHERE user = :1', users.get_current_user())
-                userprefs = q.get()
-                if userprefs:
-                    user_name = userprefs.name
-                else: # If the user does not have a preferences object,
-                      # redirect them to the user profile page.
-                    user_name = users.get_current_user().nickname()
-                    self.redirect("/user")
-                    
-                loginout_url = users.create_logout_url(self.request.uri)
-                url_linktext = 'Logout'
-                if users.is_current_user_admin():
-                    is_admin = True
-            else:
-                user_name = 'Anonymous'
-                loginout_url = users.create_login_url(self.request.uri)
-                url_linktext = 'Login'
-          
-            # Write the output to the base.html template, which combines
-            # the pre-generated static content into the final page.
-            self.response.out.write(utils.render_template('base.html', {
-                'content_body': content.body,
-                'tagcloud': tagcloud,
-                'loginout_url': loginout_url,
-                'user_name': user_name,
-                'url_linktext': url_linktext,
-                'is_admin': is_admin}))
-        else: # Straight-through content
-            self.response.out.write(content.body)
+        length = get_content_length(content, fills, gzip)
+        if length is not None:
+            self.response.headers['Content-Length'] = str(length)
+        if self.request.method == 'HEAD':
+            self.stream = []
+        else:
+            self.stream = get_pieces(content, fills, gzip)
     else:
         self.response.set_status(304) # 304 == Not Modified
 
+  def is_modified(self, content, etag, user_specific):
+    """Checks the request's conditional headers against the response.
+
+    Args:
+      content: The StaticContent being served.
+      etag: The ETag of the response.
+      user_specific: True if the response differs between users, in which
+        case If-Modified-Since is not enough to tell if it has changed.
+    Returns:
+      False if the client's copy is current and a 304 can be sent.
+    """
+    if 'If-None-Match' in self.request.headers:
+      etags = [x.strip('" ')
+               for x in self.request.headers['If-None-Match'].split(',')]
+      return etag not in etags and '*' not in etags
+    if 'If-Modified-Since' in self.request.headers and not user_specific:
+      try:
+        last_seen = datetime.datetime.strptime(
+            self.request.headers['If-Modified-Since'].split(';')[0],# IE8 '; length=XXXX' as extra arg bug
+            HTTP_DATE_FMT)
+        if last_seen >= content.last_modified.replace(microsecond=0):
+          return False
+      except ValueError:
+        import logging
+        logging.error('StaticContentHandler in static.py, ValueError:' + self.request.headers['If-Modified-Since'])
+    return True
+
+  def not_found(self):
+    """Sends the 404 page, using the copy rendered at deploy time if any."""
+    content = get(NOT_FOUND_PATH)
+    if not content:
+      self.error(404)
+      self.response.out.write(utils.render_template('404.html'))
+      return
+    user_vals = self.get_user_vals()
+    if user_vals is None:
+      return # Redirected
+    fills, version = get_slot_fills(user_vals)
+    gzip = content.has_gzip and self.accepts_gzip()
+    etag = hashlib.sha1('%s:%s' % (content.etag, version)).hexdigest()
+    if gzip:
+        etag += '-gz'
+    self.output_content(content, True, fills, etag, gzip)
+
   def get(self, path):
     if not path.startswith(config.url_prefix):
       if path not in ROOT_ONLY_FILES:
-        self.error(404)
-        self.response.out.write(utils.render_template('404.html'))
+        self.not_found()
         return
     elif config.url_prefix:
         path = path[len(config.url_prefix):]# Strip off prefix
         if path in ROOT_ONLY_FILES:# This lives at root (MF: root of what?)
-          self.error(404)
-          self.response.out.write(utils.render_template('404.html'))
+          self.not_found()
           return
     content = get(path)
     if not content:
-      self.error(404)
-      self.response.out.write(utils.render_template('404.html'))
+      self.not_found()
       return
 
-    # Determine e-tag and LastModified status
-    # Removed by Tom because WikiBlog is more dynamic than Bloggart.
-    # For instance, when redirecting back due to login, we need
-    # the header bar to refresh properly.
-    serve = True
-    #if 'If-Modified-Since' in self.request.headers:
-    #  try:
-    #    last_seen = datetime.datetime.strptime(
-    #        self.request.headers['If-Modified-Since'].split(';')[0],# IE8 '; length=XXXX' as extra arg bug
-    #        HTTP_DATE_FMT)
-    #    if last_seen >= content.last_modified.replace(microsecond=0):
-    #      serve = False
-    #  except ValueError, e:
-    #    import logging
-    #    logging.error('StaticContentHandler in static.py, ValueError:' + self.request.headers['If-Modified-Since'])
-    #if 'If-None-Match' in self.request.headers:
-    #  etags = [x.strip('" ')
-    #           for x in self.request.headers['If-None-Match'].split(',')]
-    #  if content.etag in etags:
-    #    serve = False
-
-    # Check whether the output should simply pass straight through, rather than via the base.html template.        
-    uses_base_template = True
-    if path.startswith(('/sitemap.xml','/feeds/','/search','/cse')):
-        uses_base_template = False
-    
-    self.output_content(content, serve, uses_base_template)
+    # Pages in base.html show who is logged in, so their ETag covers the
+    # user's header and the tag cloud as well as the stored content.
+    fills = None
+    etag = content.etag
+    if uses_base_template(path):
+        user_vals = self.get_user_vals()
+        if user_vals is None:
+            return # Redirected
+        fills, version = get_slot_fills(user_vals)
+        etag = hashlib.sha1('%s:%s' % (content.etag, version)).hexdigest()
+    # Each encoding of the content needs its own ETag.
+    gzip = content.has_gzip and self.accepts_gzip()
+    if gzip:
+        etag += '-gz'
+    serve = self.is_modified(content, etag, fills is not None)
+    self.output_content(content, serve, fills, etag, gzip)
+
+  def head(self, path):
+    # output_content() leaves the body out for HEAD requests.
+    self.get(path)
+
+
+class StreamingApplication(object):
+  """A WSGI application that can send a handler's response as it is made.
+
+  If the handler sets its stream attribute to an iterable of strings, those
+  are returned to the WSGI server one by one, rather than being joined into
+  the response first. Otherwise the response is sent as webapp would.
+  """
+  def __init__(self, url_mapping, debug=False):
+    self.url_mapping = [(re.compile('^%s$' % (regexp,)), handler_class)
+                        for regexp, handler_class in url_mapping]
+    self.debug = debug
+
+  def __call__(self, environ, start_response):
+    request = webapp.Request(environ)
+    response = webapp.Response()
+    handler = None
+    for regexp, handler_class in self.url_mapping:
+      match = regexp.match(request.path)
+      if match:
+        handler = handler_class()
+        handler.initialize(request, response)
+        break
+    method = environ['REQUEST_METHOD']
+    if not handler:
+      response.set_status(404)
+    elif method not in ('GET', 'HEAD'):
+      response.set_status(405)
+      response.headers['Allow'] = 'GET, HEAD'
+    else:
+      try:
+        if method == 'GET':
+          handler.get(*match.groups())
+        else:
+          handler.head(*match.groups())
+      except Exception, e:
+        handler.stream = None
+        handler.handle_exception(e, self.debug)
+    stream = getattr(handler, 'stream', None)
+    if stream is None:
+      if method == 'HEAD':
+        response.out.seek(0)
+        response.out.truncate(0)
+      response.wsgi_write(start_response)
+      return []
+    status = response.status
+    start_response('%d %s' % (status, webapp.Response.http_status_message(status)),
+                   response.headers.items())
+    return stream
+
 
-application = webapp.WSGIApplication([
+application = StreamingApplication([
                 ('(/.*)', StaticContentHandler),                
               ])
 
@@ -33,12 +33,11 @@ class UserProfileHandler(webapp.RequestHandler):
         by the user's browser with a GET request."""
         # If there's a current user logged in, pre-fill the form with
         # this user's details.
-        from google.appengine.ext import db
-        q = db.GqlQuery("SELECT * FROM UserPrefs WHERE user = :1", users.get_current_user())
-        if q.get():
-            initial_data = {'name': q.get().name}
+        user_prefs = models.UserPrefs.get_for_user(users.get_current_user())
+        if user_prefs:
+            initial_data = {'name': user_prefs.name}
             logging.info('UserProfileHandler.get in user_handlers.py, initial_data = ' + str(initial_data))
-            self.render_form(UserProfileForm(instance=q.get(),initial=initial_data))
+            self.render_form(UserProfileForm(instance=user_prefs,initial=initial_data))
         else:
             self.render_form(UserProfileForm(data=self.request.POST))
 
@@ -48,12 +47,20 @@ class UserProfileHandler(webapp.RequestHandler):
         Django takes care of including error messages and filling out values
         that the user already entered. If the form is valid, it sets the users
         preferences in a UserPrefs object """
-        form = UserProfileForm(data=self.request.POST)
+        user = users.get_current_user()
+        old_prefs = models.UserPrefs.get_for_user(user)
+        user_prefs = models.UserPrefs(key_name=user.user_id(), user=user)
+        if old_prefs:
+            # Copy onto the user id key, in case the profile predates it.
+            user_prefs.postscount = old_prefs.postscount
+            user_prefs.namepath = old_prefs.namepath
+        form = UserProfileForm(data=self.request.POST, instance=user_prefs)
         if form.is_valid():
             user_prefs = form.save(commit=False)
-            user_prefs.user = users.get_current_user()
             user_prefs.publish() # Publish finds a unique URL path for this user's author page.
             user_prefs.put()
+            if old_prefs and old_prefs.key() != user_prefs.key():
+                old_prefs.delete()
             self.redirect("/")
         else:
             self.render_form(form)
@@ -88,17 +95,15 @@ def with_post(fun):
 
 class BaseHandler(webapp.RequestHandler):
     def render_to_response(self, template_name, template_vals=None, theme=None):
-        from google.appengine.ext import db
         if not template_vals:
             template_vals = {}
         # User must be logged in to reach this handler.
         loginout_url = users.create_logout_url(self.request.uri)
         url_linktext = 'Logout'
-        q = db.GqlQuery("SELECT * FROM UserPrefs WHERE user = :1", users.get_current_user())
-        userprefs = q.get()
+        identity = models.get_identity(users.get_current_user())
         user_name = users.get_current_user().nickname() # Default to email if we can't find the user prefs, but this shouldn't actually happen...
-        if userprefs:
-                user_name = userprefs.name
+        if identity['name'] is not None:
+                user_name = identity['name']
 
         template_vals.update({
                 'path': self.request.path,
@@ -139,7 +144,6 @@ class PostHandler(BaseHandler):
         creating a new entity. It then calls .publish() on the new BlogPost
         entity. """
         
-        from google.appengine.ext import db
         form = PostForm(data=self.request.POST, instance=post,
                                         initial={})
         if form.is_valid():
@@ -149,28 +153,26 @@ class PostHandler(BaseHandler):
                 post.updated = post.published = datetime.datetime.now()
                 post.original_author_as_user = users.get_current_user() # Only assign the original user on first save of non-draft post.
                 # Find this user's name string
-                q = db.GqlQuery("SELECT * FROM UserPrefs WHERE user = :1", post.original_author_as_user)
-                userprefs = q.get()
-                if userprefs and not form._cleaned_data()['anonymous']: # If user asked to be anonymous, don't record their name.
-                    post.original_author_name = userprefs.name # Set user name string for this post.
+                user_name = models.get_identity(post.original_author_as_user)['name']
+                if user_name is not None and not form._cleaned_data()['anonymous']: # If user asked to be anonymous, don't record their name.
+                    post.original_author_name = user_name # Set user name string for this post.
                 else:
                     post.original_author_name = "Anonymous" # Change original author name to "Anonymous"
                 logging.info('PostHandler.post in user_handlers.py, original_author_name = ' + str(post.original_author_name))
             else:# Edit post
                 post.updated = datetime.datetime.now()
                 # Find this user's name string
-                q = db.GqlQuery("SELECT * FROM UserPrefs WHERE user = :1", users.get_current_user())
-                userprefs = q.get()
+                user_name = models.get_identity(users.get_current_user())['name']
                 # Add additional authors to editors list, provided they aren't the
                 # original author, and aren't already in the list.
                 logging.info('PostHandler.post in user_handlers.py, editors started = ' + str(post.editors))
-                if userprefs:
-                    if userprefs.name != post.original_author_name: # If edited by someone not the original author
-                        editor_name = userprefs.name
+                if user_name is not None:
+                    if user_name != post.original_author_name: # If edited by someone not the original author
+                        editor_name = user_name
                         if form._cleaned_data()['anonymous']: # If user asked to be anonymous
                             editor_name = "Anonymous"
-                            if userprefs.name in post.editors: # If they were previously an editor
-                                post.editors.remove(userprefs.name) # remove their name.
+                            if user_name in post.editors: # If they were previously an editor
+                                post.editors.remove(user_name) # remove their name.
                         if editor_name not in post.editors:
                             post.editors.append( editor_name )
                         post.locked = False # Only the original author or an admin should
@@ -34,11 +34,19 @@ class UserProfileHandler(webapp.RequestHandler):
         Django takes care of including error messages and filling out values
         that the user already entered. If the form is valid, it sets the users
         preferences in a UserPrefs object """
-        form = UserProfileForm(data=self.request.POST)
+        user = users.get_current_user()
+        old_prefs = models.UserPrefs.get_for_user(user)
+        user_prefs = models.UserPrefs(key_name=user.user_id(), user=user)
+        if old_prefs:
+            # Copy onto the user id key, in case the profile predates it.
+            user_prefs.postscount = old_prefs.postscount
+            user_prefs.namepath = old_prefs.namepath
+        form = UserProfileForm(data=self.request.POST, instance=user_prefs)
         if form.is_valid():
             user_prefs = form.save(commit=False)
-            user_prefs.user = users.get_current_user()
             user_prefs.put()
+            if old_prefs and old_prefs.key() != user_prefs.key():
+                old_prefs.delete()
             self.redirect('/')
         else:
             self.render_form(form)
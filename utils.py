@@ -1,7 +1,13 @@
+import datetime
+import logging
 import os
 import re
+import struct
 import unicodedata
+import zlib
 
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.template import _swap_settings
 
@@ -56,55 +62,287 @@ def format_user_path(user, num):
             'slug': slug
     }
 
+def is_devel():
+    """Returns True when running under the development server."""
+    return os.environ['SERVER_SOFTWARE'].startswith('Devel')
+
+
 def get_template_vals_defaults(template_vals=None):
     if not template_vals:
         template_vals = {}
     template_vals.update({
             'config': config,
-            'devel': os.environ['SERVER_SOFTWARE'].startswith('Devel'),
+            'devel': is_devel(),
     })
     return template_vals
 
 
+_template_cache = {}
+
+
+def _get_template(template_name):
+    """Returns the compiled template, reusing it across requests on
+    production instances so it is only read and parsed once."""
+    if is_devel():
+        return loader.get_template(template_name)
+    tpl = _template_cache.get(template_name)
+    if not tpl:
+        tpl = _template_cache[template_name] = loader.get_template(template_name)
+    return tpl
+
+
 def render_template(template_name, template_vals=None, theme=None):
     template_vals = get_template_vals_defaults(template_vals)
     template_vals.update({'template_name': template_name})
     old_settings = _swap_settings({'TEMPLATE_DIRS': TEMPLATE_DIRS})
     try:
-        tpl = loader.get_template(template_name)
+        tpl = _get_template(template_name)
         rendered = tpl.render(template.Context(template_vals))
     finally:
         _swap_settings(old_settings)
     return rendered
 
 
-def _get_all_paths():
+# Pages served through base.html are stored fully rendered, with a slot left
+# for each part of the page that differs between requests (the user's name
+# and login link, the tag cloud, ...). At serve time the slots are filled by
+# splicing strings into the stored page, so no template is rendered.
+# The nonce keeps text in a post body from being mistaken for a slot.
+SLOT_MARKER = '<!--slot:%s:%s-->'
+PAGE_SLOTS = ('analytics', 'usernav', 'sidebar')
+
+
+def compose_page(content_body, template_name='base.html'):
+    """Renders content_body into the base template, leaving the slots empty.
+
+    Returns:
+      A (page, slots) tuple: the rendered page with the slot markers cut out,
+      and a list of 'offset:name' strings giving where each slot goes.
+    """
+    nonce = os.urandom(8).encode('hex')
+    template_vals = {'content_body': content_body}
+    for name in PAGE_SLOTS:
+        template_vals[name] = SLOT_MARKER % (nonce, name)
+    return cut_slots(render_template(template_name, template_vals), nonce)
+
+
+def cut_slots(rendered, nonce):
+    """Removes slot markers from rendered, recording their offsets."""
+    pieces = []
+    slots = []
+    offset = pos = 0
+    for match in re.finditer(SLOT_MARKER % (nonce, r'(\w+)'), rendered):
+        piece = rendered[pos:match.start()]
+        pieces.append(piece)
+        offset += len(piece)
+        slots.append('%d:%s' % (offset, match.group(1)))
+        pos = match.end()
+    pieces.append(rendered[pos:])
+    return ''.join(pieces), slots
+
+
+def splice_slots(page, slots, fills):
+    """Returns a list of strings that make up page with its slots filled.
+
+    Args:
+      page: A page as returned by compose_page.
+      slots: The list of 'offset:name' strings for the page.
+      fills: A dict mapping slot names to the strings to insert.
+    """
+    pieces = []
+    pos = 0
+    for slot in slots:
+        offset, name = slot.split(':', 1)
+        offset = int(offset)
+        pieces.append(page[pos:offset])
+        pieces.append(fills.get(name, ''))
+        pos = offset
+    pieces.append(page[pos:])
+    return pieces
+
+
+def splice_chunks(chunks, slots, fills):
+    """Like splice_slots, but for a page that arrives in several chunks.
+
+    Args:
+      chunks: An iterable of strings that together make up the page.
+      slots: The list of 'offset:name' strings for the whole page.
+      fills: A dict mapping slot names to the strings to insert.
+    Yields:
+      The pieces of the page with its slots filled, as chunks arrive.
+    """
+    slots = [(int(offset), name) for offset, name in
+             (x.split(':', 1) for x in slots)]
+    i = 0
+    start = 0
+    for chunk in chunks:
+        end = start + len(chunk)
+        pos = 0
+        while i < len(slots) and slots[i][0] <= end:
+            offset, name = slots[i]
+            yield chunk[pos:offset - start]
+            yield fills.get(name, '')
+            pos = offset - start
+            i += 1
+        yield chunk[pos:]
+        start = end
+    for offset, name in slots[i:]:
+        yield fills.get(name, '')
+
+
+# Compressible content is stored gzipped as well, so it never has to be
+# compressed per request. Each segment between two slots is compressed on its
+# own and ends on a byte boundary, so compressed fills can be spliced in
+# between them and the result wrapped into a valid gzip stream.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_DEFLATE_END = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+
+def deflate(data):
+    """Compresses data to raw deflate blocks, without ending the stream."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def deflate_page(page, slots):
+    """Compresses page one segment at a time.
+
+    Returns:
+      A (deflated, gz_slots) tuple: the compressed segments, and the slots
+      list with offsets into the compressed data instead of page.
+    """
+    segments = splice_slots(page, slots, {})[::2]
+    deflated = [deflate(x) for x in segments]
+    gz_slots = []
+    offset = 0
+    for segment, slot in zip(deflated, slots):
+        offset += len(segment)
+        gz_slots.append('%d:%s' % (offset, slot.split(':', 1)[1]))
+    return ''.join(deflated), gz_slots
+
+
+def gzip_pieces(pieces, deflated, gz_slots, fills):
+    """Returns a list of strings that make up the gzipped response.
+
+    Args:
+      pieces: The uncompressed response, as returned by splice_slots.
+      deflated: The compressed page, as returned by deflate_page.
+      gz_slots: The slots in the compressed page.
+      fills: The same dict of slot fills used to build pieces.
+    """
+    crc = 0
+    size = 0
+    for piece in pieces:
+        crc = zlib.crc32(piece, crc)
+        size += len(piece)
+    deflated_fills = dict((k, deflate(v)) for k, v in fills.items() if v)
+    gzipped = [GZIP_HEADER]
+    gzipped.extend(splice_slots(deflated, gz_slots, deflated_fills))
+    gzipped.append(gzip_trailer(crc, size))
+    return gzipped
+
+
+def gzip_trailer(crc, size):
+    """Returns the end of a gzip stream for the given uncompressed data."""
+    return _DEFLATE_END + struct.pack('<LL', crc & 0xffffffff,
+                                      size & 0xffffffff)
+
+
+# The most URLs the sitemap protocol allows in one sitemap file.
+SITEMAP_MAX_URLS = 50000
+
+
+def sitemap_shard_path(shard):
+    return '/sitemap-%d.xml' % (shard,)
+
+
+def _sitemap_shard_size():
+    return max(1, min(config.sitemap_shard_size, SITEMAP_MAX_URLS))
+
+
+def _regenerate_sitemap_shard(shard):
+    """Regenerates one sitemap shard, and schedules the sitemap index.
+
+    A shard that has outgrown config.sitemap_shard_size is split first, so
+    regenerating a shard takes the same work however large the site grows.
+    """
+    import static
+    shards = static.get_sitemap_shards()
+    bounds = static.sitemap_shard_range(shard, shards)
+    if not bounds:
+        return # The sitemap was sharded afresh since this was scheduled.
+    paths = static.backend().sitemap_paths(*bounds)
+    while len(paths) > _sitemap_shard_size():
+        # The upper half of the paths move to a new shard of their own.
+        half = len(paths) // 2
+        new_shard = max(x[1] for x in shards) + 1
+        shards.append((paths[half], new_shard))
+        static.set_sitemap_shards(shards)
+        _regenerate_sitemap_shard(new_shard)
+        paths = paths[:half]
+    rendered = render_template('sitemap.xml', {'paths': paths})
+    static.set(sitemap_shard_path(shard), rendered, 'application/xml', False)
+    _schedule_sitemap_index()
+
+
+def reshard_sitemap():
+    """Splits the sitemap into shards afresh, each half full so it has room
+    to grow, and schedules them to be regenerated.
+
+    Sitemap files of shards that no longer exist are removed.
+    """
     import static
-    keys = []
-    q = static.StaticContent.all(keys_only=True).filter('indexed', True)
-    cur = q.fetch(1000)
-    while len(cur) == 1000:
-        keys.extend(cur)
-        q = static.StaticContent.all(keys_only=True)
-        q.filter('indexed', True)
-        q.filter('__key__ >', cur[-1])
-        cur = q.fetch(1000)
-    keys.extend(cur)
-    return [x.name() for x in keys]
+    paths = static.backend().sitemap_paths('')
+    size = max(1, _sitemap_shard_size() // 2)
+    shards = [('', 0)]
+    for i in range(size, len(paths), size):
+        shards.append((paths[i], len(shards)))
+    static.set_sitemap_shards(shards)
+    current = dict((sitemap_shard_path(x[1]), True) for x in shards)
+    stale = [x for x in static.backend().paths_between('/sitemap-', '/sitemap.')
+             if x not in current]
+    if stale:
+        static.remove_multi(stale)
+    for start, shard in shards:
+        deferred.defer(_regenerate_sitemap_shard, shard)
+
+
+def _schedule_sitemap_index():
+    """Schedules the sitemap index to be regenerated, and Google pinged.
+
+    Shards changed together are regenerated within the same minute, so this
+    runs once, at the end of the minute after the first of them.
+    """
+    now = datetime.datetime.now()
+    eta = now.replace(second=0, microsecond=0) + datetime.timedelta(seconds=65)
+    try:
+        deferred.defer(_regenerate_sitemap,
+                       _name='sitemapindex-%s' % now.strftime('%Y%m%d%H%M'),
+                       _eta=eta)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass # The index is already due to be regenerated.
 
 
 def _regenerate_sitemap():
+    """Regenerates the sitemap index from the current shards."""
     import static
     import gzip
     from StringIO import StringIO
-    paths = _get_all_paths()
-    rendered = render_template('sitemap.xml', {'paths': paths})
-    static.set('/sitemap.xml', rendered, 'application/xml', False)
+    paths = [sitemap_shard_path(x[1]) for x in static.get_sitemap_shards()]
+    shards = []
+    for path in paths:
+        content = static.get(path)
+        if content:
+            shards.append({'path': path, 'last_modified': content.last_modified})
+    rendered = render_template('sitemapindex.xml', {'shards': shards})
     s = StringIO()
     gzip.GzipFile(fileobj=s,mode='wb').write(rendered)
     s.seek(0)
     renderedgz = s.read()
-    static.set('/sitemap.xml.gz',renderedgz, 'application/x-gzip', False)
+    static.set_multi([
+        ('/sitemap.xml', rendered, 'application/xml', False),
+        ('/sitemap.xml.gz', renderedgz, 'application/x-gzip', False),
+    ])
     if config.google_sitemap_ping:
             ping_googlesitemap()
 